@@ -0,0 +1,3 @@
+from .mock_server import MockStreetViewServer
+
+__all__ = [MockStreetViewServer]
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import io
+import random
+from typing import *
+
+import numpy as np
+import orjson
+from aiohttp import web
+from PIL import Image
+
+METADATA_PATH = "/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/GetMetadata"
+SEARCH_PATH = "/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/SingleImageSearch"
+TILE_PATH = "/v1/tile"
+
+
+# local stand-in for Street View metadata and tile endpoints, with log-normal response latency,
+# random errors (HTTP 503) and throttling (HTTP 429, in-band "service unavailable" for single image search)
+class MockStreetViewServer:
+    def __init__(
+        self,
+        metadata_latency: float = 0.05,
+        tile_latency: float = 0.03,
+        latency_sigma: float = 0.5,
+        error_rate: float = 0,
+        throttle_rate: float = 0,
+        tile_size: Tuple[int, int] = (512, 512),
+        tile_quality: int = 85,
+        n_zooms: int = 6,
+        seed: int = 0,
+    ) -> None:
+        # latencies are medians in seconds
+        self.metadata_latency = metadata_latency
+        self.tile_latency = tile_latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.tile_size = tile_size
+        self.n_zooms = n_zooms
+        self.random = random.Random(seed)
+        self.counters = {"metadata": 0, "search": 0, "tiles": 0, "tile_bytes": 0, "errors": 0, "throttled": 0}
+
+        # a few pre-encoded noise tiles, so that their size is close to the real ones
+        rng = np.random.default_rng(seed)
+        self.tiles = []
+        for _ in range(4):
+            pixels = rng.integers(0, 256, (*tile_size, 3), dtype=np.uint8)
+            output = io.BytesIO()
+            Image.fromarray(pixels).save(output, format="JPEG", quality=tile_quality)
+            self.tiles.append(output.getvalue())
+
+        self.app = web.Application()
+        self.app.router.add_post(METADATA_PATH, self.handle_metadata)
+        self.app.router.add_post(SEARCH_PATH, self.handle_search)
+        self.app.router.add_get(TILE_PATH, self.handle_tile)
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    def sizes(self) -> List[Any]:
+        # zoom 0 is a single tile high, each next zoom doubles resolution
+        return [[[self.tile_size[0] * 2**zoom // 2, self.tile_size[0] * 2**zoom]] for zoom in range(self.n_zooms)]
+
+    def metadata_node(self, panoid: str, lat: float, lng: float) -> Any:
+        # only the fields parsed by aigeo.google.calls
+        return [
+            None,
+            [None, panoid],
+            [None, None, None, [self.sizes(), list(self.tile_size)]],
+            None,
+            None,
+            [[None, [[None, None, lat, lng], None, None, None, "US"]]],
+        ]
+
+    async def respond_delay(self, median: float) -> None:
+        if median > 0:
+            await asyncio.sleep(median * self.random.lognormvariate(0, self.latency_sigma))
+
+    def failure(self) -> Optional[str]:
+        x = self.random.random()
+        if x < self.error_rate:
+            self.counters["errors"] += 1
+            return "error"
+        if x < self.error_rate + self.throttle_rate:
+            self.counters["throttled"] += 1
+            return "throttled"
+        return None
+
+    async def handle_metadata(self, request: web.Request) -> web.Response:
+        self.counters["metadata"] += 1
+        body = orjson.loads(await request.read())
+        panoid = body[2][0][0][1]
+        await self.respond_delay(self.metadata_latency)
+        return self.metadata_response(lambda: [[0], [self.metadata_node(panoid, 0.0, 0.0)]], in_band=False)
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        self.counters["search"] += 1
+        body = orjson.loads(await request.read())
+        lat, lng = body[1][0][2], body[1][0][3]
+        panoid = hashlib.sha1(f"{lat},{lng}".encode()).hexdigest()[:22]
+        await self.respond_delay(self.metadata_latency)
+        return self.metadata_response(lambda: [[0], self.metadata_node(panoid, lat, lng)], in_band=True)
+
+    def metadata_response(self, data: Callable[[], Any], in_band: bool) -> web.Response:
+        failure = self.failure()
+        if failure == "error":
+            return web.Response(status=503, text="Service Unavailable")
+        if failure == "throttled" and in_band:
+            return web.Response(body=orjson.dumps([[3], "The service is currently unavailable."]))
+        if failure == "throttled":
+            return web.Response(status=429, text="Too Many Requests")
+        return web.Response(body=orjson.dumps(data()), content_type="application/json")
+
+    async def handle_tile(self, request: web.Request) -> web.Response:
+        self.counters["tiles"] += 1
+        await self.respond_delay(self.tile_latency)
+        failure = self.failure()
+        if failure == "error":
+            return web.Response(status=503, text="Service Unavailable")
+        if failure == "throttled":
+            return web.Response(status=429, text="Too Many Requests")
+        tile = self.tiles[hash(request.query_string) % len(self.tiles)]
+        self.counters["tile_bytes"] += len(tile)
+        return web.Response(body=tile, content_type="image/jpeg")
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def __aenter__(self) -> Self:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
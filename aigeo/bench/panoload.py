@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+import orjson
+
+from aigeo.cli.panoload.args import setup_parser as panoload_setup_parser
+from aigeo.cli.panoload.main import main as panoload_main
+from aigeo.cli.panoload.sharding import find_shards, shard_filename
+from aigeo.google import RateLimiter
+from aigeo.utils import iter_locations
+
+from .mock_server import MockStreetViewServer
+
+
+# rate limiter configured by panoload options, which also appends response times of all requests
+# to a file per process (panoload workers run in their own processes)
+class LatencyRecorder(RateLimiter):
+    def __init__(self, latencies_dir: str, **options: Any) -> None:
+        super().__init__(**options)
+        self.file = open(Path(latencies_dir) / f"{os.getpid()}.txt", "a", buffering=1)
+
+    def record(self, status: Optional[int], latency: float, throttled: bool = False) -> None:
+        super().record(status, latency, throttled)
+        self.file.write(f"{latency}\n")
+
+
+def read_latencies(latencies_dir: Path) -> List[float]:
+    latencies = []
+    for path in latencies_dir.iterdir():
+        with open(path, "r") as f:
+            latencies.extend(float(line) for line in f if line.strip())
+    return latencies
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def count_loaded(args: argparse.Namespace) -> int:
+    # parts of --shard are not merged, each of them has its own output
+    output_dir = Path(args.output_dir)
+    if args.shard is None:
+        paths = [output_dir / args.json_filename]
+    else:
+        shards = find_shards(output_dir, args.json_filename)
+        paths = [output_dir / shard_filename(args.json_filename, shard) for shard in shards]
+    return sum(1 for path in paths for _ in iter_locations(path))
+
+
+def run_panoload(url: str, infile: str, options: List[str]) -> Dict[str, Any]:
+    # runs in a separate process, so that its peak RSS is not mixed with the others
+    with tempfile.TemporaryDirectory() as output_dir, tempfile.TemporaryDirectory() as latencies_dir:
+        parser = argparse.ArgumentParser()
+        panoload_setup_parser(parser)
+        args = parser.parse_args([infile, "-o", output_dir, "--api-url", url, "--tiles-url", url, *options])
+        if args.merge:
+            raise ValueError("--merge can not be benchmarked")
+
+        start = time.perf_counter()
+        panoload_main(args, limiter_factory=functools.partial(LatencyRecorder, latencies_dir))
+        elapsed = time.perf_counter() - start
+
+        n_loaded = count_loaded(args)
+        latencies = read_latencies(Path(latencies_dir))
+
+    peak_rss = max(resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN])
+    return {
+        "elapsed": elapsed,
+        "loaded": n_loaded,
+        "requests": len(latencies),
+        "p50_latency": percentile(latencies, 0.5),
+        "p99_latency": percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss / 1024,
+    }
+
+
+def write_locations(path: Path, n: int, search_fraction: float) -> None:
+    # first locations are given by lat/lng (resolved by single image search), the others by panoid
+    n_search = round(n * search_fraction)
+    locations = [{"lat": i * 1e-4, "lng": -i * 1e-4} for i in range(n_search)]
+    locations += [{"panoid": f"bench{i:017d}"} for i in range(n_search, n)]
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(locations))
+
+
+def setup_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-n", "--locations", type=int, default=200, help="number of locations per run")
+    parser.add_argument(
+        "--search-fraction",
+        type=float,
+        default=0,
+        help="fraction of locations given by lat/lng instead of panoid",
+    )
+    parser.add_argument("-b", "--batch-size", type=int, nargs="+", default=[8, 32], help="values of -b to try")
+    parser.add_argument("-l", "--conn-limit", type=int, nargs="+", default=[64], help="values of -l to try")
+    parser.add_argument("-z", "--zoom", type=int, nargs="+", default=[2], help="values of -z to try")
+    parser.add_argument("--metadata-latency", type=float, default=0.05, help="median metadata response time")
+    parser.add_argument("--tile-latency", type=float, default=0.03, help="median tile response time")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of log-normal response time")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of responses with HTTP 503")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of throttled responses")
+    parser.add_argument("--tile-size", type=int, nargs=2, default=[512, 512], metavar=("H", "W"), help="tile size")
+    parser.add_argument("--tile-quality", type=int, default=85, help="JPEG quality of tiles")
+    parser.add_argument("-o", "--output", type=str, default=None, help="output JSON with results")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="throughput of panoload against a local mock Street View server. "
+        + "Unknown arguments are passed to panoload",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    setup_parser(parser)
+    args, panoload_options = parser.parse_known_args()
+
+    server = MockStreetViewServer(
+        metadata_latency=args.metadata_latency,
+        tile_latency=args.tile_latency,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        tile_size=tuple(args.tile_size),
+        tile_quality=args.tile_quality,
+        n_zooms=max(args.zoom) + 1,
+    )
+    # server has its own event loop, so that it does not compete with panoload for it
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    url = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        infile = str(Path(tmp_dir) / "locations.json")
+        write_locations(Path(infile), args.locations, args.search_fraction)
+
+        for batch_size, conn_limit, zoom in itertools.product(args.batch_size, args.conn_limit, args.zoom):
+            options = ["-b", str(batch_size), "-l", str(conn_limit), "-z", str(zoom), *panoload_options]
+            before = dict(server.counters)
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(run_panoload, url, infile, options).result()
+            counts = {key: server.counters[key] - before[key] for key in server.counters}
+
+            result = {
+                "batch_size": batch_size,
+                "conn_limit": conn_limit,
+                "zoom": zoom,
+                "locations_per_sec": result["loaded"] / result["elapsed"],
+                "tiles_per_sec": counts["tiles"] / result["elapsed"],
+                "mb_per_sec": counts["tile_bytes"] / 2**20 / result["elapsed"],
+                **result,
+                "server": counts,
+            }
+            results.append(result)
+            print(orjson.dumps(result).decode(), flush=True)
+
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+    if args.output is not None:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    main()
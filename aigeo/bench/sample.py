@@ -0,0 +1,187 @@
+import argparse
+import importlib.metadata
+import itertools
+import os
+import platform
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import orjson
+import torch
+from PIL import Image
+
+from aigeo.cli.sample.args import setup_parser as sample_setup_parser
+from aigeo.cli.sample.main import main as sample_main
+from aigeo.transforms import PanoConverter
+from aigeo.transforms.pano_converter import prepare_base_mapping
+
+DTYPES = {"uint8": torch.uint8, "float32": torch.float32}
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> Dict[str, float]:
+    # seconds per call
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times), "mean": statistics.fmean(times)}
+
+
+def synthetic_panoramas(n: int, height: int, dtype: torch.dtype, seed: int = 0) -> torch.Tensor:
+    # smooth noise, so that JPEG sizes and decoding times are closer to the real ones than with white noise
+    generator = torch.Generator().manual_seed(seed)
+    coarse = torch.rand((n, 3, max(height // 16, 1), max(height // 8, 1)), generator=generator)
+    panoramas = torch.nn.functional.interpolate(coarse, size=(height, 2 * height), mode="bilinear") * 255
+    return panoramas.to(dtype)
+
+
+def bench_mapping(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    for size, threads in itertools.product(args.sizes, args.threads):
+        torch.set_num_threads(threads)
+        timing = measure(lambda: prepare_base_mapping(size, 0.3, 0.1, 1.2, args.device), args.repeat)
+        yield {"benchmark": "prepare_base_mapping", "size": size, "threads": threads, "seconds": timing}
+
+
+def bench_convert(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    settings = itertools.product(args.sizes, args.batch_sizes, args.resolutions, args.dtypes, args.threads)
+    for size, batch_size, resolution, dtype, threads in settings:
+        torch.set_num_threads(threads)
+        converter = PanoConverter(size, 0.3, 0.1, 1.2, batch_size, args.device, cache=None)
+        pano_batch = synthetic_panoramas(batch_size, resolution, DTYPES[dtype])
+
+        def convert() -> None:
+            converter.convert(pano_batch)
+            if torch.device(args.device).type == "cuda":
+                torch.cuda.synchronize()
+
+        timing = measure(convert, args.repeat)
+        yield {
+            "benchmark": "PanoConverter.convert",
+            "size": size,
+            "batch_size": batch_size,
+            "resolution": resolution,
+            "dtype": dtype,
+            "threads": threads,
+            "seconds": timing,
+            "panoramas_per_sec": batch_size / timing["median"],
+        }
+
+
+def write_storage(directory: Path, n: int, resolution: int) -> Path:
+    # JSON with synthetic JPEG panoramas in the layout written by panoload
+    (directory / "panoramas").mkdir(parents=True, exist_ok=True)
+    panoramas = synthetic_panoramas(n, resolution, torch.uint8)
+    locations = []
+    for i, panorama in enumerate(panoramas):
+        path = f"panoramas/{i}.jpg"
+        Image.fromarray(panorama.permute(1, 2, 0).numpy()).save(directory / path, format="JPEG")
+        locations.append({"metadata": {"lat": 0.0, "lng": 0.0}, "panorama": path})
+    storage = directory / "storage.json"
+    with open(storage, "wb") as f:
+        f.write(orjson.dumps(locations))
+    return storage
+
+
+def bench_sample(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for resolution in args.resolutions:
+            storage = write_storage(Path(tmp_dir) / f"storage-{resolution}", args.count, resolution)
+            for size, batch_size, threads in itertools.product(args.sizes, args.batch_sizes, args.threads):
+                torch.set_num_threads(threads)
+                parser = argparse.ArgumentParser()
+                sample_setup_parser(parser)
+                output_dir = Path(tmp_dir) / "output"
+                sample_args = parser.parse_args(
+                    [str(storage), "-o", str(output_dir), "-s", str(size), "-b", str(batch_size), "-d", args.device]
+                    + args.sample_options
+                )
+                timing = measure(lambda: sample_main(sample_args), args.repeat)
+                yield {
+                    "benchmark": "sample",
+                    "size": size,
+                    "batch_size": batch_size,
+                    "resolution": resolution,
+                    "threads": threads,
+                    "seconds": timing,
+                    "panoramas_per_sec": args.count / timing["median"],
+                }
+
+
+BENCHMARKS = {"mapping": bench_mapping, "convert": bench_convert, "sample": bench_sample}
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        version = importlib.metadata.version("aigeo")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return {
+        "aigeo": version,
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def setup_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        choices=list(BENCHMARKS),
+        default=list(BENCHMARKS),
+        help="benchmarks to run",
+    )
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[256, 512], help="output image sizes")
+    parser.add_argument("-b", "--batch-sizes", type=int, nargs="+", default=[1, 8], help="batch sizes")
+    parser.add_argument(
+        "-r",
+        "--resolutions",
+        type=int,
+        nargs="+",
+        default=[1024, 2048],
+        help="heights of synthetic panoramas (width is twice as big)",
+    )
+    parser.add_argument(
+        "--dtypes", type=str, nargs="+", choices=list(DTYPES), default=list(DTYPES), help="panorama dtypes"
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, nargs="+", default=[torch.get_num_threads()], help="numbers of torch threads"
+    )
+    parser.add_argument("-d", "--device", type=str, default="cpu", help="torch device")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="number of measured runs")
+    parser.add_argument("-c", "--count", type=int, default=32, help="number of panoramas for sample benchmark")
+    parser.add_argument("-o", "--output", type=str, default=None, help="output JSON with results")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="microbenchmarks of panorama conversion and sample pipeline on synthetic panoramas. "
+        + "Unknown arguments are passed to sample",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    setup_parser(parser)
+    args, args.sample_options = parser.parse_known_args()
+
+    results = []
+    for name in args.benchmarks:
+        for result in BENCHMARKS[name](args):
+            results.append(result)
+            print(orjson.dumps(result).decode(), flush=True)
+
+    if args.output is not None:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps({"environment": environment(), "results": results}, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,69 @@
 import argparse
 
+from .sharding import parse_shard
+
+
+def parse_positive_float(value: str) -> float:
+    x = float(value)
+    if x <= 0:
+        raise argparse.ArgumentTypeError(f"expected positive number, got {value!r}")
+    return x
+
 
 def setup_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "infile",
         type=str,
-        help="input JSON with locations. Each location must have either panoid "
+        help="input JSON (array or map export with customCoordinates) or JSON lines (.jsonl) with locations, "
+        + "read incrementally. Each location must have either panoid "
         + "or lat/lng for obtaining panoid through Google single_image_search API call",
     )
     parser.add_argument(
         "-z",
         "--zoom",
         type=int,
+        nargs="+",
         choices=range(7),
-        default=3,
-        help="panorama zoom level",
+        default=[3],
+        help="panorama zoom level(s). Panorama is downloaded only at the highest one, "
+        + "lower ones are downsampled from it and stored as JPEG",
+    )
+    parser.add_argument(
+        "--storage-format",
+        type=str,
+        choices=["jpeg", "tiles"],
+        default="jpeg",
+        help="format of stored panoramas: stitched JPEG, or original tiles without recompression (ZIP archive)",
+    )
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="store panoramas in large append-only shard files with an index inside images directory, "
+        + "instead of one file per panorama",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="i/N",
+        help="process only i-th of N deterministic parts of input (e.g. on one of N machines). "
+        + "Locations with the same panoid go to the same part, locations given only by lat/lng are split by index "
+        + "(so different parts can load the same panorama). "
+        + "Outputs are written next to the other parts' ones and combined with --merge",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes, each processing its own part of input (of --shard, if given). "
+        + "Their outputs are merged when all of them finish. --rate is split between workers",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="only combine outputs of all parts (--shard runs) found in output directory into one JSON "
+        + "(and journal with -j)",
     )
     parser.add_argument(
         "-b",
@@ -23,6 +72,18 @@ def setup_parser(parser: argparse.ArgumentParser) -> None:
         default=8,
         help="max number of simultaneously processed locations",
     )
+    parser.add_argument(
+        "--metadata-limit",
+        type=int,
+        default=0,
+        help="max number of simultaneous metadata requests (0 for no limit)",
+    )
+    parser.add_argument(
+        "--tile-limit",
+        type=int,
+        default=0,
+        help="max number of simultaneous tile downloads (0 for no limit)",
+    )
     parser.add_argument(
         "-l",
         "--conn-limit",
@@ -36,7 +97,98 @@ def setup_parser(parser: argparse.ArgumentParser) -> None:
         default=0,
         help="max number of simultaneous TCP connections per host",
     )
-    parser.add_argument("--json-filename", type=str, default="storage.json", help="name of output JSON")
+    parser.add_argument(
+        "--io-workers",
+        type=int,
+        default=4,
+        help="number of threads for saving panoramas (encoding and filesystem access), "
+        + "0 to do it in event loop (blocking downloads)",
+    )
+    parser.add_argument(
+        "--io-queue",
+        type=int,
+        default=8,
+        help="max number of panoramas waiting to be saved, downloads of the next ones wait for them",
+    )
+    parser.add_argument("--rate", type=float, default=0, help="max number of requests per second (0 for no limit)")
+    parser.add_argument(
+        "--adaptive-rate",
+        action="store_true",
+        help="find the highest sustainable request rate automatically (AIMD), starting from --rate",
+    )
+    parser.add_argument("--min-rate", type=parse_positive_float, default=1, help="min request rate for --adaptive-rate")
+    parser.add_argument("--max-rate", type=float, default=1000, help="max request rate for --adaptive-rate")
+    parser.add_argument(
+        "--latency-threshold",
+        type=float,
+        default=None,
+        help="response time in seconds, above which request is treated as throttled",
+    )
+    parser.add_argument("--backoff-base", type=float, default=0.5, help="base delay in seconds between retries")
+    parser.add_argument("--backoff-max", type=float, default=30, help="max delay in seconds between retries")
+    parser.add_argument(
+        "--api-url",
+        type=str,
+        default=None,
+        help="base URL of metadata API, e.g. of a local mock server (Google API by default)",
+    )
+    parser.add_argument("--tiles-url", type=str, default=None, help="base URL of tiles API (Google API by default)")
+    parser.add_argument(
+        "--metadata-cache",
+        type=str,
+        default=None,
+        help="path of SQLite database for caching metadata API calls between runs (disabled by default)",
+    )
+    parser.add_argument(
+        "--metadata-cache-ttl",
+        type=float,
+        default=30,
+        help="time in days after which cached metadata is requested again",
+    )
+    parser.add_argument(
+        "--metadata-cache-size",
+        type=int,
+        default=10_000_000,
+        help="max number of entries in metadata cache, least recently used ones are evicted",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="enable instrumentation and append its snapshots (counters, gauges, latency histograms) "
+        + "to this JSON lines file",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="enable instrumentation and serve it in Prometheus text format on http://127.0.0.1:PORT/metrics "
+        + "(PORT+k for k-th of --workers)",
+    )
+    parser.add_argument("--metrics-interval", type=float, default=10, help="seconds between metrics snapshots")
+    parser.add_argument(
+        "-j",
+        "--journal",
+        action="store_true",
+        help="stream processed locations to an append-only journal and skip locations already recorded in it "
+        + "(input must be the same between runs, journal of a run with other --zoom or --storage-format is refused)",
+    )
+    parser.add_argument("--journal-filename", type=str, default="journal.jsonl", help="name of journal")
+    parser.add_argument(
+        "--registry",
+        action="store_true",
+        help="keep metadata and paths of all loaded panoramas in a JSON lines file and reuse them between runs "
+        + "(the whole file is loaded into memory)",
+    )
+    parser.add_argument(
+        "--registry-filename",
+        type=str,
+        default="panoramas.jsonl",
+        help="name of registry file",
+    )
+    parser.add_argument(
+        "--json-filename", type=str, default="storage.json", help="name of output JSON (.jsonl for JSON lines)"
+    )
     parser.add_argument("--images-dir", type=str, default="panoramas", help="name of images directory")
     parser.add_argument(
         "-o",
@@ -0,0 +1,64 @@
+import argparse
+from pathlib import Path
+from typing import *
+
+from aigeo.utils import append_json_line, iter_json_lines, open_json_lines_for_append
+
+
+def journal_options(args: argparse.Namespace) -> Dict[str, Any]:
+    # options, which change what is stored for a location, so it can not be skipped when they change
+    return {"zoom": sorted(set(args.zoom)), "storage_format": args.storage_format}
+
+
+def read_journal_options(path: Path) -> Optional[Dict[str, Any]]:
+    for entry in iter_json_lines(path, skip_invalid=True):
+        if "options" in entry:
+            return entry["options"]
+    return None
+
+
+def iter_journal_entries(path: Path) -> Iterator[Any]:
+    return (entry for entry in iter_json_lines(path, skip_invalid=True) if "index" in entry)
+
+
+# append-only JSON lines file of processed locations, keyed by their index in input. Its header has options of the run,
+# journal of a run with other options is refused (or started over with reset=True)
+class Journal:
+    def __init__(self, path: Path, options: Dict[str, Any], reset: bool = False) -> None:
+        self.path = path
+        self.options = options
+        self.done: Set[int] = set()
+
+        recorded = read_journal_options(path) if path.exists() else None
+        if recorded is not None and recorded != options:
+            if not reset:
+                raise ValueError(
+                    f"journal {path} was written with options {recorded}, but got {options}. "
+                    + "Remove it or choose another --journal-filename to start over"
+                )
+            path.unlink()
+            recorded = None
+
+        if path.exists():
+            for entry in self.entries():
+                self.done.add(entry["index"])
+
+        self.file = open_json_lines_for_append(path)
+        if recorded is None:
+            append_json_line(self.file, {"options": options})
+
+    def entries(self) -> Iterator[Any]:
+        return iter_journal_entries(self.path)
+
+    def append(self, index: int, location: Any) -> None:
+        append_json_line(self.file, {"index": index, "location": location})
+        self.done.add(index)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
@@ -1,25 +1,183 @@
 import argparse
 import asyncio
-import itertools
+import concurrent.futures
+import contextlib
+import functools
+import io
+import os
 import traceback
+import uuid
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Iterator, Optional, Sequence, Tuple
 
 import aiohttp
 import orjson
+from PIL import Image
 from tqdm import tqdm
 
-from aigeo.google import get_metadata, get_pano, single_image_search
-from aigeo.utils import get_first
+from aigeo.google import (
+    MetadataCache,
+    RateLimiter,
+    get_metadata,
+    get_pano,
+    get_pano_size,
+    get_pano_tiles,
+    set_base_urls,
+    set_metadata_cache,
+    set_rate_limiter,
+    single_image_search,
+    stitch_tiles,
+)
+from aigeo.storage import TILE_ARCHIVE_EXTENSION, ShardStore, TileArchive, is_tile_archive, write_tile_archive
+from aigeo.utils import (
+    AsyncBoundedExecutor,
+    JsonWriter,
+    LoopLagMonitor,
+    export_metrics,
+    get_first,
+    get_metrics,
+    iter_locations,
+    limited,
+    map_unordered,
+    write_json_items,
+)
+
+from .journal import Journal, journal_options
+from .registry import PanoramaRegistry
+from .sharding import merge_shards, select_shard, shard_args, split_shard
+
+
+def panorama_exists(storage_dir: Path, rel_path: str | Path, store: Optional[ShardStore]) -> bool:
+    if store is not None and (storage_dir / rel_path).parent == store.path:
+        return Path(rel_path).name in store
+    return (storage_dir / rel_path).exists()
+
+
+def panorama_path(images_dir: str, panoid: str, extension: str, zoom: int, sharded: bool) -> Path:
+    # every zoom level has its own suffix, so that a stored panorama is never mistaken for another zoom level
+    name = f"{panoid}_z{zoom}"
+    if sharded:
+        return Path(images_dir) / f"{name}{extension}"
+    return Path(images_dir) / panoid[0] / panoid[1] / f"{name}{extension}"
+
+
+def save_panorama(save: Callable[[Any], None], storage_dir: Path, rel_path: Path, store: Optional[ShardStore]) -> None:
+    with get_metrics().timer("save_seconds", format=rel_path.suffix.lstrip(".")):
+        if store is not None:
+            output = io.BytesIO()
+            save(output)
+            store.put(rel_path.name, output.getvalue())
+        else:
+            abs_path = storage_dir / rel_path
+            abs_path.parent.mkdir(parents=True, exist_ok=True)
+            # panorama appears only when complete, so that concurrent saves of the same panorama (e.g. by workers
+            # resolving lat/lng to the same panoid) or a crash never leave a truncated file, which would count as loaded
+            tmp_path = abs_path.with_name(f".{abs_path.name}.{uuid.uuid4().hex}.tmp")
+            try:
+                save(tmp_path)
+                os.replace(tmp_path, abs_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+
+
+def load_stored_panorama(storage_dir: Path, rel_path: Path, store: Optional[ShardStore]) -> Image.Image:
+    if store is not None and (storage_dir / rel_path).parent == store.path:
+        source = store.open(rel_path.name)
+    else:
+        source = storage_dir / rel_path
+    if is_tile_archive(rel_path):
+        with TileArchive(source) as archive:
+            return Image.fromarray(archive.read())
+    image = Image.open(source)
+    image.load()
+    return image
+
+
+def save_resized_panorama(
+    pano: Image.Image, size: Tuple[int, int], storage_dir: Path, rel_path: Path, store: Optional[ShardStore]
+) -> None:
+    with get_metrics().timer("resize_seconds"):
+        resized = pano.resize((size[1], size[0]), Image.Resampling.BOX)
+    save_panorama(functools.partial(resized.save, format="JPEG"), storage_dir, rel_path, store)
+
+
+async def run_blocking[R](executor: Optional[AsyncBoundedExecutor], fn: Callable[..., R], *args: Any) -> R:
+    # filesystem access and encoding should not block event loop with downloads in flight
+    if executor is None:
+        return fn(*args)
+    with get_metrics().track("io_pending"):
+        return await executor.run(fn, *args)
+
+
+async def download_panorama(
+    metadata: Any,
+    storage_dir: Path,
+    images_dir: str,
+    zooms: Sequence[int],
+    session: aiohttp.ClientSession,
+    tile_limiter: Optional[asyncio.Semaphore] = None,
+    storage_format: str = "jpeg",
+    store: Optional[ShardStore] = None,
+    executor: Optional[AsyncBoundedExecutor] = None,
+) -> Dict[int, str]:
+    # panorama is downloaded once at the highest zoom level, lower ones are downsampled from it
+    # (and always stored as JPEG)
+    panoid = metadata["panoid"]
+    tile_size = metadata["tile_size"]
+    top, *lower = sorted(set(zooms), reverse=True)
+    extension = TILE_ARCHIVE_EXTENSION if storage_format == "tiles" else ".jpg"
+    paths = {top: panorama_path(images_dir, panoid, extension, top, store is not None)}
+    for zoom in lower:
+        paths[zoom] = panorama_path(images_dir, panoid, ".jpg", zoom, store is not None)
+    missing = [
+        zoom
+        for zoom, rel_path in paths.items()
+        if not await run_blocking(executor, panorama_exists, storage_dir, rel_path, store)
+    ]
+
+    if len(missing) > 0:
+        pano_args = (session, panoid, metadata["sizes"], tile_size, top, tile_limiter)
+        metrics = get_metrics()
+        if top not in missing:
+            # only derived zoom levels are missing, they are downsampled from the stored panorama
+            pano = await run_blocking(executor, load_stored_panorama, storage_dir, paths[top], store)
+        elif storage_format == "tiles":
+            with metrics.timer("download_seconds"):
+                tiles, size = await get_pano_tiles(*pano_args)
+            save = functools.partial(write_tile_archive, tiles=tiles, size=size, tile_size=tile_size)
+            await run_blocking(executor, save_panorama, save, storage_dir, paths[top], store)
+            if missing != [top]:
+                pano = Image.fromarray(await run_blocking(executor, stitch_tiles, tiles, size, tile_size))
+        else:
+            with metrics.timer("download_seconds"):
+                pano = await get_pano(*pano_args)
+            save = functools.partial(pano.save, format="JPEG")
+            await run_blocking(executor, save_panorama, save, storage_dir, paths[top], store)
+
+        for zoom in lower:
+            if zoom in missing:
+                size = get_pano_size(metadata["sizes"][zoom], tile_size)
+                await run_blocking(executor, save_resized_panorama, pano, size, storage_dir, paths[zoom], store)
+
+    return {zoom: str(rel_path.as_posix()) for zoom, rel_path in paths.items()}
 
 
 async def process_location(
     location: Any,
     storage_dir: Path,
     images_dir: str,
-    zoom: int,
+    zooms: Sequence[int],
     session: aiohttp.ClientSession,
+    metadata_limiter: Optional[asyncio.Semaphore] = None,
+    tile_limiter: Optional[asyncio.Semaphore] = None,
+    storage_format: str = "jpeg",
+    store: Optional[ShardStore] = None,
+    registry: Optional[PanoramaRegistry] = None,
+    executor: Optional[AsyncBoundedExecutor] = None,
 ) -> Optional[bool]:
+    async def exists(rel_path: str) -> bool:
+        return await run_blocking(executor, panorama_exists, storage_dir, rel_path, store)
+
     try:
         # load location metadata
         if "metadata" not in location:
@@ -31,62 +189,250 @@ async def process_location(
                 return
 
             if panoid is not None:
-                location["metadata"] = await get_metadata(session, panoid)
+
+                def load_metadata() -> Awaitable[Any]:
+                    return limited(metadata_limiter, get_metadata(session, panoid))
+
+                if registry is not None:
+                    location["metadata"] = await registry.get_metadata(panoid, load_metadata)
+                else:
+                    location["metadata"] = await load_metadata()
             else:
-                location["metadata"] = await single_image_search(session, lat, lng)
+                location["metadata"] = await limited(metadata_limiter, single_image_search(session, lat, lng))
 
         # load panorama
         metadata = location["metadata"]
-        panoid = metadata["panoid"]
-        rel_path = Path(images_dir) / panoid[0] / panoid[1] / f"{panoid}.jpg"
-        abs_path = storage_dir / rel_path
-        if "panorama" not in location or not (storage_dir / location["panorama"]).exists():
-            if not abs_path.exists():
-                pano = await get_pano(
-                    session,
-                    metadata["panoid"],
-                    metadata["sizes"],
-                    metadata["tile_size"],
-                    zoom,
-                )
-                abs_path.parent.mkdir(parents=True, exist_ok=True)
-                pano.save(abs_path)
-
-            location["panorama"] = str(rel_path.as_posix())
+        # zoom level of a single stored panorama is unknown, its path is checked by download_panorama then
+        known = location.get("panoramas", {})
+        if not all([str(zoom) in known and await exists(known[str(zoom)]) for zoom in zooms]):
+            load_panorama = functools.partial(
+                download_panorama,
+                metadata,
+                storage_dir,
+                images_dir,
+                zooms,
+                session,
+                tile_limiter,
+                storage_format,
+                store,
+                executor,
+            )
+            if registry is not None:
+                panoramas = await registry.get_panorama(metadata, load_panorama, exists)
+            else:
+                panoramas = await load_panorama()
+
+            location["panorama"] = panoramas[max(zooms)]
+            if len(panoramas) > 1:
+                location["panoramas"] = {str(zoom): panoramas[zoom] for zoom in sorted(panoramas)}
 
         return True
-    except Exception:
+    except Exception as e:
+        get_metrics().inc("errors_total", type=type(e).__name__)
         tqdm.write(f"[warning]: skipped location due to error: {traceback.format_exc()}")
         return False
 
 
+def create_session(args: argparse.Namespace) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=args.conn_limit, limit_per_host=args.conn_limit_per_host)
+    )
+
+
+def open_store(args: argparse.Namespace) -> ContextManager[Optional[ShardStore]]:
+    if args.sharded:
+        return ShardStore(Path(args.output_dir) / args.images_dir)
+    return contextlib.nullcontext()
+
+
+def open_registry(args: argparse.Namespace) -> PanoramaRegistry:
+    path = Path(args.output_dir) / args.registry_filename if args.registry else None
+    return PanoramaRegistry(path, args.zoom, args.storage_format)
+
+
+def open_executor(args: argparse.Namespace) -> AsyncBoundedExecutor:
+    return AsyncBoundedExecutor(args.io_workers, args.io_queue)
+
+
+def location_processor(
+    args: argparse.Namespace,
+    session: aiohttp.ClientSession,
+    store: Optional[ShardStore],
+    registry: PanoramaRegistry,
+    executor: AsyncBoundedExecutor,
+) -> Callable[[Tuple[int, Any]], Awaitable[Optional[bool]]]:
+    storage_dir = Path(args.output_dir)
+    metadata_limiter = asyncio.Semaphore(args.metadata_limit) if args.metadata_limit > 0 else None
+    tile_limiter = asyncio.Semaphore(args.tile_limit) if args.tile_limit > 0 else None
+    metrics = get_metrics()
+
+    async def process(item: Tuple[int, Any]) -> Optional[bool]:
+        _, location = item
+        with metrics.track("locations_in_flight"):
+            ok = await process_location(
+                location,
+                storage_dir,
+                args.images_dir,
+                args.zoom,
+                session,
+                metadata_limiter,
+                tile_limiter,
+                args.storage_format,
+                store,
+                registry,
+                executor,
+            )
+        metrics.inc("locations_total", result={True: "ok", False: "failed", None: "skipped"}[ok])
+        return ok
+
+    return process
+
+
 async def load_panoramas(args: argparse.Namespace) -> None:
     storage_dir = Path(args.output_dir)
+    storage_dir.mkdir(parents=True, exist_ok=True)
+    locations = select_shard(iter_locations(args.infile), args.shard)
+
+    # locations taken from input, but not processed yet
+    in_flight: Dict[int, Any] = {}
+
+    def take_locations() -> Iterator[Tuple[int, Any]]:
+        for i, location in locations:
+            in_flight[i] = location
+            yield i, location
+
+    # locations are written in order of completion, as soon as they are processed
+    with JsonWriter(storage_dir / args.json_filename) as writer:
+        try:
+            with open_store(args) as store, open_registry(args) as registry, open_executor(args) as executor:
+                async with create_session(args) as session:
+                    processor = location_processor(args, session, store, registry, executor)
+                    results = map_unordered(processor, take_locations(), args.batch_size)
+                    progress = tqdm(unit="loc")
+                    async for (i, location), ok in results:
+                        del in_flight[i]
+                        if ok:
+                            writer.write(location)
+                        progress.update()
+        except (KeyboardInterrupt, asyncio.exceptions.CancelledError):
+            tqdm.write("interrupted, saving to JSON...")
+        finally:
+            # unprocessed locations are kept in output
+            for location in in_flight.values():
+                writer.write(location)
+            for _, location in locations:
+                writer.write(location)
+
+
+async def load_panoramas_journaled(args: argparse.Namespace) -> None:
+    storage_dir = Path(args.output_dir)
+    storage_dir.mkdir(parents=True, exist_ok=True)
+
+    with (
+        Journal(storage_dir / args.journal_filename, journal_options(args)) as journal,
+        open_store(args) as store,
+        open_registry(args) as registry,
+        open_executor(args) as executor,
+    ):
+        if len(journal.done) > 0:
+            tqdm.write(f"resuming, {len(journal.done)} locations are already processed")
+        try:
+            async with create_session(args) as session:
+                locations = select_shard(iter_locations(args.infile), args.shard)
+                pending = ((i, loc) for i, loc in locations if i not in journal.done)
+                processor = location_processor(args, session, store, registry, executor)
+                results = map_unordered(processor, pending, args.batch_size)
+                progress = tqdm(unit="loc")
+                async for (i, loc), ok in results:
+                    if ok:
+                        journal.append(i, loc)
+                    progress.update()
+        except (KeyboardInterrupt, asyncio.exceptions.CancelledError):
+            tqdm.write("interrupted, saving to JSON...")
+        finally:
+            write_json_items(storage_dir / args.json_filename, (entry["location"] for entry in journal.entries()))
 
-    with open(args.infile, "r", encoding="utf-8") as f:
-        locations = orjson.loads(f.read())
-    if not isinstance(locations, list):
-        if "customCoordinates" not in locations:
-            raise ValueError("unknown format of JSON file")
-        locations = locations["customCoordinates"]
 
-    selectors: list[Optional[bool]] = [True for _ in locations]
+async def run_with_lag_monitor(coro: Awaitable[None]) -> None:
+    monitor = LoopLagMonitor()
     try:
-        async with aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(limit=args.conn_limit, limit_per_host=args.conn_limit_per_host)
-        ) as session:
-            batches = itertools.batched(locations, args.batch_size)
-            for i, loc_batch in enumerate(tqdm(batches, total=len(locations) // args.batch_size)):
-                tasks = [process_location(loc, storage_dir, args.images_dir, args.zoom, session) for loc in loc_batch]
-                from_, to_ = i * args.batch_size, (i + 1) * args.batch_size
-                selectors[from_:to_] = await asyncio.gather(*tasks)
-    except (KeyboardInterrupt, asyncio.exceptions.CancelledError):
-        tqdm.write("interrupted, saving to JSON...")
+        async with monitor:
+            await coro
     finally:
-        locations = list(itertools.compress(locations, selectors))
-        with open(str(storage_dir / args.json_filename), "wb") as f:
-            f.write(orjson.dumps(locations))
+        tqdm.write(f"event loop lag (ms): {orjson.dumps(monitor.stats()).decode()}")
+
+
+def run_workers(args: argparse.Namespace, limiter_factory: Callable[..., RateLimiter] = RateLimiter) -> None:
+    # request rate limits are global, so they are split between workers
+    limits = {
+        "rate": args.rate / args.workers,
+        "min_rate": args.min_rate / args.workers,
+        "max_rate": args.max_rate / args.workers,
+    }
+    workers_args = []
+    for k, shard in enumerate(split_shard(args.shard or (0, 1), args.workers)):
+        worker_args = argparse.Namespace(**{**vars(args), **limits, "shard": shard, "workers": 1})
+        if args.metrics_port is not None:
+            worker_args.metrics_port = args.metrics_port + k
+        workers_args.append(worker_args)
+    interrupted = False
+    try:
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+            for _ in executor.map(functools.partial(main, limiter_factory=limiter_factory), workers_args):
+                pass
+    except KeyboardInterrupt:
+        tqdm.write("interrupted, waiting for workers to save their outputs...")
+        interrupted = True
 
+    if args.shard is None:
+        # workers' outputs are kept after interruption, so that journaled run can be resumed with the same workers
+        merge_shards(args, count=args.workers, remove=not interrupted)
+    else:
+        # outputs of other machines' parts are not here yet
+        tqdm.write("outputs of all parts can be combined with --merge")
 
-def main(args: argparse.Namespace) -> None:
-    asyncio.run(load_panoramas(args))
+
+def main(args: argparse.Namespace, limiter_factory: Callable[..., RateLimiter] = RateLimiter) -> None:
+    # limiter_factory is called with rate limiter options, in every worker process
+    if args.merge:
+        merge_shards(args)
+        return
+    if args.workers > 1:
+        run_workers(args, limiter_factory)
+        return
+    if args.shard is not None:
+        args = shard_args(args, args.shard)
+
+    limiter = limiter_factory(
+        rate=args.rate,
+        adaptive=args.adaptive_rate,
+        min_rate=args.min_rate,
+        max_rate=args.max_rate,
+        latency_threshold=args.latency_threshold,
+        backoff_base=args.backoff_base,
+        backoff_max=args.backoff_max,
+    )
+    set_rate_limiter(limiter)
+    set_base_urls(args.api_url, args.tiles_url)
+
+    cache = None
+    if args.metadata_cache is not None:
+        cache = MetadataCache(
+            args.metadata_cache, ttl=args.metadata_cache_ttl * 24 * 3600, max_entries=args.metadata_cache_size
+        )
+        set_metadata_cache(cache)
+
+    try:
+        with export_metrics(args.metrics_file, args.metrics_port, args.metrics_interval):
+            if args.journal:
+                asyncio.run(run_with_lag_monitor(load_panoramas_journaled(args)))
+            else:
+                asyncio.run(run_with_lag_monitor(load_panoramas(args)))
+    finally:
+        tqdm.write(f"requests: {orjson.dumps(limiter.counters).decode()}")
+        if args.adaptive_rate:
+            tqdm.write(f"final request rate: {limiter.rate:.1f}/s")
+        if cache is not None:
+            cache.close()
+            set_metadata_cache(None)
+            tqdm.write(f"metadata cache: {orjson.dumps(cache.counters).decode()}")
@@ -0,0 +1,86 @@
+import asyncio
+from pathlib import Path
+from typing import *
+
+from aigeo.utils import append_json_line, iter_json_lines, open_json_lines_for_append
+
+
+# concurrent requests for the same panoid share a single call. With path, known panoramas (metadata and
+# stored paths) are also kept in memory and persisted as JSON lines between runs
+class PanoramaRegistry:
+    def __init__(self, path: Optional[Path], zooms: Sequence[int], storage_format: str) -> None:
+        self.path = path
+        self.zooms = sorted(set(zooms))
+        self.storage_format = storage_format
+        self.metadata: Dict[str, Any] = {}
+        self.panoramas: Dict[str, Dict[int, str]] = {}
+
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self.file: Optional[BinaryIO] = None
+        if path is None:
+            return
+
+        if path.exists():
+            for entry in iter_json_lines(path, skip_invalid=True):
+                self.metadata[entry["panoid"]] = entry["metadata"]
+                if entry["storage_format"] == storage_format and entry["zoom"] == max(self.zooms):
+                    panoramas = entry.get("panoramas", {entry["zoom"]: entry["panorama"]})
+                    known = self.panoramas.setdefault(entry["panoid"], {})
+                    known.update({int(zoom): path for zoom, path in panoramas.items()})
+
+        self.file = open_json_lines_for_append(path)
+
+    async def get_metadata(self, panoid: str, load: Callable[[], Awaitable[Any]]) -> Any:
+        if panoid in self.metadata:
+            return self.metadata[panoid]
+        return await self._shared(("metadata", panoid), load)
+
+    async def get_panorama(
+        self,
+        metadata: Any,
+        load: Callable[[], Awaitable[Dict[int, str]]],
+        exists: Callable[[str], Awaitable[bool]],
+    ) -> Dict[int, str]:
+        # paths of panorama keyed by zoom level
+        panoid = metadata["panoid"]
+        known = self.panoramas.get(panoid, {})
+        if all([zoom in known and await exists(known[zoom]) for zoom in self.zooms]):
+            return {zoom: known[zoom] for zoom in self.zooms}
+
+        async def load_and_record() -> Dict[int, str]:
+            panoramas = await load()
+            if self.file is None:
+                return panoramas
+            self.metadata[panoid] = metadata
+            self.panoramas.setdefault(panoid, {}).update(panoramas)
+            entry = {
+                "panoid": panoid,
+                "metadata": metadata,
+                "panorama": panoramas[max(self.zooms)],
+                "panoramas": {str(zoom): path for zoom, path in panoramas.items()},
+                "zoom": max(self.zooms),
+                "storage_format": self.storage_format,
+            }
+            append_json_line(self.file, entry)
+            return panoramas
+
+        return await self._shared(("panorama", panoid), load_and_record)
+
+    async def _shared[R](self, key: Tuple[str, str], load: Callable[[], Awaitable[R]]) -> R:
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(load())
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # cancelling one of the waiters should not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import re
+import zlib
+from pathlib import Path
+from typing import *
+
+import orjson
+from tqdm import tqdm
+
+from aigeo.utils import (
+    append_json_line,
+    get_first,
+    iter_json_lines,
+    iter_locations,
+    open_json_lines_for_append,
+    write_json_items,
+)
+
+from .journal import Journal, iter_journal_entries, journal_options, read_journal_options
+
+type Shard = Tuple[int, int]
+
+
+def parse_shard(value: str) -> Shard:
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected i/N")
+    index, count = int(match[1]), int(match[2])
+    if count < 1 or index >= count:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected 0 <= i < N")
+    return index, count
+
+
+def split_shard(shard: Shard, n: int) -> List[Shard]:
+    # n shards, covering exactly the given one
+    index, count = shard
+    return [(index + count * k, count * n) for k in range(n)]
+
+
+def location_shard(index: int, location: Any, count: int) -> int:
+    # locations with the same panoid always go to the same shard, so they are still deduplicated. Locations given
+    # by lat/lng are split by index, so different shards can resolve them to the same panorama
+    panoid = get_first(location, ["panoId", "panoid"])
+    key = panoid if panoid is not None else str(index)
+    return zlib.crc32(key.encode()) % count
+
+
+def select_shard(locations: Iterable[Any], shard: Optional[Shard]) -> Iterator[Tuple[int, Any]]:
+    # locations of shard with their indices in the whole input
+    for i, location in enumerate(locations):
+        if shard is None or location_shard(i, location, shard[1]) == shard[0]:
+            yield i, location
+
+
+def shard_filename(filename: str, shard: Shard) -> str:
+    path = Path(filename)
+    return f"{path.stem}.shard-{shard[0]}-of-{shard[1]}{path.suffix}"
+
+
+def find_shards(directory: Path, filename: str) -> List[Shard]:
+    path = Path(filename)
+    pattern = re.compile(rf"{re.escape(path.stem)}\.shard-(\d+)-of-(\d+){re.escape(path.suffix)}")
+    shards = []
+    for child in directory.iterdir():
+        match = pattern.fullmatch(child.name)
+        if match is not None:
+            shards.append((int(match[1]), int(match[2])))
+    return sorted(shards)
+
+
+def shard_args(args: argparse.Namespace, shard: Shard) -> argparse.Namespace:
+    # arguments of a single shard run, which writes its outputs next to the other shards' ones
+    changes = {
+        "shard": shard,
+        "workers": 1,
+        "json_filename": shard_filename(args.json_filename, shard),
+        "journal_filename": shard_filename(args.journal_filename, shard),
+        "registry_filename": shard_filename(args.registry_filename, shard),
+    }
+    if args.metrics_file is not None:
+        changes["metrics_file"] = shard_filename(args.metrics_file, shard)
+    if args.sharded:
+        # shard stores have a single writer
+        changes["images_dir"] = f"{args.images_dir}/shard-{shard[0]}-of-{shard[1]}"
+    return argparse.Namespace(**{**vars(args), **changes})
+
+
+def merge_shards(args: argparse.Namespace, count: Optional[int] = None, remove: bool = False) -> None:
+    # count selects outputs of a single sharding, when directory has outputs of several ones
+    storage_dir = Path(args.output_dir)
+    shards = find_shards(storage_dir, args.journal_filename if args.journal else args.json_filename)
+    if count is not None:
+        shards = [shard for shard in shards if shard[1] == count]
+    if len(shards) == 0:
+        raise ValueError(f"no shard outputs found in {storage_dir}")
+
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        raise ValueError(f"outputs of different shardings found in {storage_dir}: {sorted(counts)}")
+    (count,) = counts
+    missing = sorted(set(range(count)) - {index for index, _ in shards})
+    if len(missing) > 0:
+        tqdm.write(f"[warning]: outputs of shards {missing} (of {count}) are missing")
+
+    if args.journal:
+        paths = [storage_dir / shard_filename(args.journal_filename, shard) for shard in shards]
+        options = {orjson.dumps(read_journal_options(path) or journal_options(args)) for path in paths}
+        if len(options) > 1:
+            raise ValueError(f"journals of shards in {storage_dir} were written with different options")
+        # merged journal of a run with other options is outdated by shards' ones
+        with Journal(storage_dir / args.journal_filename, orjson.loads(options.pop()), reset=True) as journal:
+            for path in paths:
+                for entry in iter_journal_entries(path):
+                    if entry["index"] not in journal.done:
+                        journal.append(entry["index"], entry["location"])
+            write_json_items(storage_dir / args.json_filename, (entry["location"] for entry in journal.entries()))
+    else:
+        paths = [storage_dir / shard_filename(args.json_filename, shard) for shard in shards]
+        write_json_items(storage_dir / args.json_filename, itertools.chain.from_iterable(map(iter_locations, paths)))
+
+    registry_paths = [storage_dir / shard_filename(args.registry_filename, shard) for shard in shards]
+    registry_paths = [path for path in registry_paths if path.exists()]
+    if len(registry_paths) > 0:
+        merge_registries(storage_dir / args.registry_filename, registry_paths)
+
+    if remove:
+        # images of shard stores are referenced by merged output, so they are kept
+        for shard in shards:
+            for filename in [args.json_filename, args.journal_filename, args.registry_filename]:
+                (storage_dir / shard_filename(filename, shard)).unlink(missing_ok=True)
+
+    tqdm.write(f"merged outputs of {len(shards)} shards")
+
+
+def merge_registries(registry_path: Path, paths: List[Path]) -> None:
+    # registry entries are only appended, so merging twice should not duplicate them
+    known: Set[bytes] = set()
+    if registry_path.exists():
+        known.update(orjson.dumps(entry) for entry in iter_json_lines(registry_path, skip_invalid=True))
+    with open_json_lines_for_append(registry_path) as f:
+        for path in paths:
+            for entry in iter_json_lines(path, skip_invalid=True):
+                key = orjson.dumps(entry)
+                if key not in known:
+                    known.add(key)
+                    append_json_line(f, entry)
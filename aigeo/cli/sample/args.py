@@ -2,7 +2,7 @@ import argparse
 
 
 def setup_parser(parser: argparse.ArgumentParser) -> None:
-    parser.add_argument("input", type=str, help="input JSON with locations")
+    parser.add_argument("input", type=str, help="input JSON or JSON lines (.jsonl) with locations")
     parser.add_argument("-s", "--size", type=int, default=512, help="size of generated images")
     parser.add_argument("-b", "--batch-size", type=int, default=8, help="batch size for converting")
     parser.add_argument("-d", "--device", type=str, default="cpu", help="torch device for converting")
@@ -22,8 +22,109 @@ def setup_parser(parser: argparse.ArgumentParser) -> None:
         help="vertical angle of camera ([-90, 90], 0=forward)",
     )
     parser.add_argument("-f", "--fov", type=float, default=0.5, help="FOV of camera ([0, 180])")
-    parser.add_argument("--json-filename", type=str, default="sample.json", help="name of output JSON")
+    views = parser.add_mutually_exclusive_group()
+    views.add_argument(
+        "--headings",
+        type=int,
+        default=None,
+        help="sample N views with evenly spaced horizontal angles, starting from --phi",
+    )
+    views.add_argument(
+        "--cubemap",
+        action="store_true",
+        help="sample 6 cubemap faces (FOV=90) instead of a single view",
+    )
+    views.add_argument(
+        "--pose",
+        type=float,
+        nargs=3,
+        action="append",
+        metavar=("PHI", "THETA", "FOV"),
+        help="sample view with given camera angles (can be repeated)",
+    )
+    for angle in ["phi", "theta", "fov"]:
+        parser.add_argument(
+            f"--{angle}-range",
+            type=float,
+            nargs=2,
+            default=None,
+            metavar=("MIN", "MAX"),
+            help=f"sample {angle} uniformly from given range for each image (overrides --{angle})",
+        )
+    parser.add_argument(
+        "--grid-cache-dir",
+        type=str,
+        default=None,
+        help="directory for caching sampling grids between runs",
+    )
+    parser.add_argument(
+        "--partial-decode",
+        action="store_true",
+        help="decode only the part of panorama seen by camera, at reduced scale if it is finer than output",
+    )
+    parser.add_argument(
+        "--panorama-height",
+        type=int,
+        default=None,
+        help="resize panoramas to this height (keeping aspect ratio), so that panoramas of different resolutions "
+        + "are converted in the same batches",
+    )
+    parser.add_argument(
+        "--batch-memory",
+        type=float,
+        default=1024,
+        help="max size (MB) of batch buffers and decoded panoramas waiting for their batches to fill up "
+        + "(half for each). Partially filled batches are converted and least recently used buffers are released "
+        + "when it is exceeded",
+    )
+    parser.add_argument(
+        "--batch-max-age",
+        type=int,
+        default=None,
+        help="convert partially filled batch after this many more panoramas have been decoded",
+    )
+    parser.add_argument(
+        "--batch-flush",
+        type=str,
+        choices=["oldest", "largest"],
+        default="oldest",
+        help="which partially filled batch is converted first when --batch-memory is exceeded",
+    )
+    parser.add_argument("--decode-workers", type=int, default=4, help="number of threads for decoding panoramas")
+    parser.add_argument("--prefetch", type=int, default=16, help="max number of panoramas decoded ahead of converter")
+    parser.add_argument("--encode-workers", type=int, default=4, help="number of threads for encoding images")
+    parser.add_argument("--encode-queue", type=int, default=64, help="max number of images waiting for encoding")
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="enable instrumentation (decode, convert and save times, queue depths) "
+        + "and append its snapshots to this JSON lines file",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="enable instrumentation and serve it in Prometheus text format on http://127.0.0.1:PORT/metrics",
+    )
+    parser.add_argument("--metrics-interval", type=float, default=10, help="seconds between metrics snapshots")
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="JSON lines file of panoramas known to exist, which are not checked again "
+        + "(created if missing, checked panoramas are added to it)",
+    )
+    parser.add_argument(
+        "--json-filename", type=str, default="sample.json", help="name of output JSON (.jsonl for JSON lines)"
+    )
     parser.add_argument("--images-dir", type=str, default="images", help="name of images directory")
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="store images in large append-only shard files with an index inside images directory, "
+        + "instead of one file per image",
+    )
     parser.add_argument(
         "-a",
         "--append",
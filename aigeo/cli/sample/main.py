@@ -1,91 +1,260 @@
 import argparse
+import contextlib
+import functools
+import io
+import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import *
 
-import orjson
 import torch
-from PIL import Image
-from torchvision.transforms.functional import pil_to_tensor, to_pil_image
+from torchvision.transforms.functional import to_pil_image
 from tqdm import tqdm
 
-from aigeo.transforms import PanoConverter
-from aigeo.utils import batchedby
+from aigeo.storage import PanoramaManifest, PanoramaReader, ShardStore, is_shard_store
+from aigeo.transforms import (
+    BatchBuffers,
+    GridCache,
+    MultiViewPanoConverter,
+    RandomPoseConverter,
+    cubemap_poses,
+    default_grid_cache,
+    heading_poses,
+    load_panorama,
+    load_panorama_region,
+)
+from aigeo.utils import (
+    BoundedExecutor,
+    JsonWriter,
+    batchedby,
+    export_metrics,
+    get_metrics,
+    iter_locations,
+    prefetch_map,
+)
+
+
+def to_radians(degrees: float) -> float:
+    return degrees / 180 * torch.pi
+
+
+def to_degrees(radians: float) -> float:
+    return float(radians / torch.pi * 180)
+
+
+def get_poses(args: argparse.Namespace) -> List[Tuple[float, float, float]]:
+    if args.headings is not None:
+        return heading_poses(args.headings, to_radians(args.theta), to_radians(args.fov), to_radians(args.phi))
+    if args.cubemap:
+        return cubemap_poses()
+    if args.pose is not None:
+        return [tuple(map(to_radians, pose)) for pose in args.pose]
+    return [(to_radians(args.phi), to_radians(args.theta), to_radians(args.fov))]
+
+
+def is_random_pose(args: argparse.Namespace) -> bool:
+    return any(r is not None for r in [args.phi_range, args.theta_range, args.fov_range])
+
+
+def get_pose_ranges(args: argparse.Namespace) -> List[Tuple[float, float]]:
+    ranges = []
+    for r, value in [(args.phi_range, args.phi), (args.theta_range, args.theta), (args.fov_range, args.fov)]:
+        ranges.append(tuple(map(to_radians, r if r is not None else (value, value))))
+    return ranges
+
+
+def sample_locations(locations: Iterable[Any], count: int) -> List[Any]:
+    # reservoir sampling, only chosen locations are kept in memory
+    chosen = []
+    total = 0
+    for i, location in enumerate(locations):
+        if i < count:
+            chosen.append(location)
+        else:
+            j = random.randint(0, i)
+            if j < count:
+                chosen[j] = location
+        total += 1
+    if count >= total:
+        raise ValueError("--count should not be bigger than number of locations")
+    random.shuffle(chosen)
+    return chosen
+
+
+def save_image(image: torch.Tensor, path: Path, store: Optional[ShardStore]) -> None:
+    with get_metrics().timer("save_seconds"):
+        if store is not None:
+            output = io.BytesIO()
+            to_pil_image(image).save(output, format="JPEG")
+            store.put(path.name, output.getvalue())
+        else:
+            to_pil_image(image).save(path)
+
+
+def open_store(args: argparse.Namespace, images_dir: Path) -> ContextManager[Optional[ShardStore]]:
+    # images in the same directory are either all in shard store or all in separate files
+    if any(images_dir.iterdir()) and args.sharded != is_shard_store(images_dir):
+        raise ValueError(
+            f"{images_dir} already has images stored {'in separate files' if args.sharded else 'in shard store'}"
+        )
+    if args.sharded:
+        return ShardStore(images_dir)
+    return contextlib.nullcontext()
+
+
+def open_manifest(args: argparse.Namespace) -> ContextManager[Optional[PanoramaManifest]]:
+    if args.manifest is not None:
+        return PanoramaManifest(args.manifest)
+    return contextlib.nullcontext()
 
 
 def main(args: argparse.Namespace) -> None:
     sample_dir = Path(args.output)
     sample_dir.mkdir(parents=True, exist_ok=True)
-    storage_dir = Path(args.input).parent
+    reader = PanoramaReader(Path(args.input).parent)
     output_json = sample_dir / args.json_filename
 
-    with open(args.input, "r", encoding="utf-8") as f:
-        locations = orjson.loads(f.read())
-    if not isinstance(locations, list):
-        if "customCoordinates" not in locations:
-            raise ValueError("unknown format of JSON file")
-        locations = locations["customCoordinates"]
-
-    for location in locations:
-        if "panorama" not in location:
-            raise RuntimeError("found location without panorama in input JSON")
-        if not (storage_dir / location["panorama"]).exists():
-            raise RuntimeError("found location with invalid panorama in input JSON (no such file)")
-
-    if args.append:
-        with open(output_json, "rb") as f:
-            out_locations = orjson.loads(f.read())
-    else:
-        out_locations = []
+    # locations are read one by one, as they are needed
+    locations = iter_locations(args.input)
+    if args.count is not None:
+        locations = sample_locations(locations, args.count)
 
-    if args.count is None:
-        indices = list(range(len(locations)))
+    if is_random_pose(args):
+        if args.headings is not None or args.cubemap or args.pose is not None:
+            raise ValueError("random poses can not be combined with --headings, --cubemap or --pose")
+        phi_range, theta_range, fov_range = get_pose_ranges(args)
+        converter = RandomPoseConverter(
+            size=args.size,
+            phi_range=phi_range,
+            theta_range=theta_range,
+            fov_range=fov_range,
+            batch_size=args.batch_size,
+            device=args.device,
+        )
     else:
-        if args.count >= len(locations):
-            raise ValueError("--count should not be bigger than number of locations")
-        indices = torch.randperm(len(locations))[: args.count].tolist()
-
-    converter = PanoConverter(
-        size=args.size,
-        phi=args.phi / 180 * torch.pi,
-        theta=args.theta / 180 * torch.pi,
-        fov=args.fov / 180 * torch.pi,
-        batch_size=args.batch_size,
-        device=args.device,
-    )
+        poses = get_poses(args)
+        converter = MultiViewPanoConverter(
+            size=args.size,
+            poses=poses,
+            batch_size=args.batch_size,
+            device=args.device,
+            cache=default_grid_cache if args.grid_cache_dir is None else GridCache(cache_dir=args.grid_cache_dir),
+        )
+
+    partial_decode = args.partial_decode and isinstance(converter, MultiViewPanoConverter)
+    if args.partial_decode and not partial_decode:
+        tqdm.write("[warning]: --partial-decode is not supported with random poses, decoding whole panoramas")
 
-    opened_panoramas = map(
-        lambda i: (
-            i,
-            pil_to_tensor(Image.open(storage_dir / locations[i]["panorama"])).float(),
-        ),
-        tqdm(indices),
+    # memory budget is split between batch buffers and decoded panoramas waiting for their batches
+    batch_memory = int(args.batch_memory * 2**20)
+    buffers = BatchBuffers(
+        args.batch_size, pin_memory=torch.device(args.device).type == "cuda", max_bytes=batch_memory // 2
     )
-    batches = batchedby(opened_panoramas, key=lambda x: x[1].shape, n=args.batch_size)
 
-    images_counter = len(out_locations)
+    (sample_dir / args.images_dir).mkdir(parents=True, exist_ok=True)
+    missing: List[str] = []
+    # locations without panorama are left in storage JSON by interrupted panoload
+    not_loaded = 0
 
     try:
-        for batch in batches:
-            indices_batch, images = zip(*batch)
-            converted_images = converter.convert(torch.stack(images))
-            converted_images = map(lambda t: to_pil_image(t.to(torch.uint8)), converted_images)
-
-            for i, converted_image in zip(indices_batch, converted_images):
-                fn = Path(args.images_dir) / f"{images_counter}.jpg"
-                images_counter += 1
-
-                (sample_dir / fn).parent.mkdir(parents=True, exist_ok=True)
-                converted_image.save(sample_dir / fn)
-
-                metadata = locations[i]["metadata"]
-                out_locations.append(
-                    {
-                        "lat": metadata["lat"],
-                        "lng": metadata["lng"],
-                        "image": str(fn.as_posix()),
-                    }
+        with (
+            JsonWriter(output_json, append=args.append) as writer,
+            open_manifest(args) as manifest,
+            open_store(args, sample_dir / args.images_dir) as store,
+            export_metrics(args.metrics_file, args.metrics_port, args.metrics_interval),
+            ThreadPoolExecutor(args.decode_workers) as decoder,
+            BoundedExecutor(args.encode_workers, args.encode_queue) as encoder,
+        ):
+            images_counter = writer.count
+            metrics = get_metrics()
+            if partial_decode:
+                load = functools.partial(
+                    load_panorama_region, reader=reader, converter=converter, height=args.panorama_height
                 )
+            else:
+                load = functools.partial(load_panorama, reader=reader, height=args.panorama_height)
+
+            def decode(location: Any) -> Tuple[Any, Optional[torch.Tensor], Any]:
+                # existence is checked in decoding threads, only for panoramas being sampled
+                path = location.get("panorama")
+                if path is None:
+                    return location, None, None
+                if (manifest is None or path not in manifest) and not reader.exists(path):
+                    return location, None, None
+                try:
+                    with metrics.timer("decode_seconds"):
+                        image, crop = load(path)
+                except FileNotFoundError:
+                    # panorama was removed after it had been added to manifest
+                    return location, None, None
+                if manifest is not None:
+                    manifest.add(path)
+                return location, image, crop
+
+            def skip_missing(panoramas: Iterable[Tuple[Any, Optional[torch.Tensor], Any]]) -> Iterator[Any]:
+                nonlocal not_loaded
+                for location, image, crop in panoramas:
+                    if image is None and "panorama" not in location:
+                        not_loaded += 1
+                        metrics.inc("missing_panoramas_total", reason="not_loaded")
+                    elif image is None:
+                        missing.append(location["panorama"])
+                        metrics.inc("missing_panoramas_total", reason="missing_file")
+                    else:
+                        yield location, image, crop
+
+            def encode(view: torch.Tensor, path: Path) -> None:
+                metrics.add("encode_queue", -1)
+                save_image(view, path, store)
+
+            opened_panoramas = prefetch_map(decode, locations, decoder, args.prefetch)
+            batches = batchedby(
+                skip_missing(tqdm(opened_panoramas, total=args.count)),
+                key=lambda x: (x[1].shape, x[2]),
+                n=args.batch_size,
+                max_size=batch_memory // 2,
+                size=lambda x: x[1].nbytes,
+                max_age=args.batch_max_age,
+                flush=args.batch_flush,
+            )
+
+            for batch in batches:
+                locations_batch, images, crops = zip(*batch)
+                with metrics.timer("convert_seconds"):
+                    pano_batch = buffers.stack(images)
+                    if isinstance(converter, RandomPoseConverter):
+                        converted_images, batch_poses = converter.convert(pano_batch)
+                        converted_images = converted_images.unsqueeze(1)
+                        batch_poses = [[pose] for pose in batch_poses.tolist()]
+                    else:
+                        converted_images = converter.convert(pano_batch, *(crops[0] or ()))
+                        batch_poses = [poses] * len(locations_batch)
+                    converted_images = converted_images.cpu()
+                metrics.inc("panoramas_total", len(locations_batch))
+
+                for location, views, views_poses in zip(locations_batch, converted_images, batch_poses):
+                    for (phi, theta, fov), view in zip(views_poses, views):
+                        fn = Path(args.images_dir) / f"{images_counter}.jpg"
+                        images_counter += 1
+
+                        metrics.add("encode_queue", 1)
+                        encoder.submit(encode, view, sample_dir / fn)
+
+                        metadata = location["metadata"]
+                        writer.write(
+                            {
+                                "lat": metadata["lat"],
+                                "lng": metadata["lng"],
+                                "image": str(fn.as_posix()),
+                                "phi": to_degrees(phi),
+                                "theta": to_degrees(theta),
+                                "fov": to_degrees(fov),
+                            }
+                        )
     except KeyboardInterrupt:
         tqdm.write("interrupted, saving to JSON...")
     finally:
-        with open(output_json, "wb") as f:
-            f.write(orjson.dumps(out_locations))
+        if not_loaded > 0:
+            tqdm.write(f"[warning]: skipped {not_loaded} locations without panorama")
+        if len(missing) > 0:
+            tqdm.write(f"[warning]: skipped {len(missing)} locations with missing panoramas: {', '.join(missing[:5])}")
@@ -0,0 +1,5 @@
+from .panorama_views import PanoramaViewDataset
+
+__all__ = [
+    PanoramaViewDataset,
+]
@@ -0,0 +1,142 @@
+import random
+from pathlib import Path
+from typing import *
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from aigeo.storage import PanoramaReader
+from aigeo.transforms import (
+    BatchBuffers,
+    GridCache,
+    MultiViewPanoConverter,
+    RandomPoseConverter,
+    default_grid_cache,
+    load_panorama,
+)
+from aigeo.utils import batchedby, country_codes_to_index, iter_locations
+
+
+def shuffled[T](iterable: Iterable[T], buffer_size: int, rng: random.Random) -> Iterator[T]:
+    # approximate shuffling of a stream, with only buffer_size items in memory
+    buffer: List[T] = []
+    for x in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(x)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = x
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+# perspective views sampled on the fly from panoramas loaded by panoload (storage JSON or JSON lines).
+# Items are dicts of (C, size, size) uint8 view, its pose (phi, theta, fov in radians), lat, lng and country index
+# (-1 for countries not in country_codes_by_index). Locations are split between DataLoader workers
+# (and between processes, with shard=(index, count)), each worker converts its panoramas in batches
+class PanoramaViewDataset(IterableDataset):
+    def __init__(
+        self,
+        storage: str | Path,
+        size: int = 512,
+        poses: Optional[Sequence[Tuple[float, float, float]]] = None,
+        pose_ranges: Optional[Sequence[Tuple[float, float]]] = None,
+        batch_size: int = 8,
+        panorama_height: Optional[int] = None,
+        batch_memory: float = 2**30,
+        shuffle_buffer: int = 0,
+        seed: int = 0,
+        shard: Optional[Tuple[int, int]] = None,
+        device: Any = "cpu",
+        cache: Optional[GridCache] = default_grid_cache,
+    ) -> None:
+        # either fixed poses of views, or (phi, theta, fov) ranges for a single random view per panorama
+        if (poses is None) == (pose_ranges is None):
+            raise ValueError("expected either poses or pose_ranges")
+        if pose_ranges is not None and len(pose_ranges) != 3:
+            raise ValueError("expected ranges of phi, theta and fov")
+
+        self.storage = Path(storage)
+        self.size = size
+        self.poses = poses
+        self.pose_ranges = pose_ranges
+        self.batch_size = batch_size
+        self.panorama_height = panorama_height
+        self.batch_memory = batch_memory
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.shard = shard
+        self.device = device
+        self.cache = cache
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        # changes order of shuffling and random poses (DataLoader should not have persistent workers)
+        self.epoch = epoch
+
+    def worker_shard(self) -> Tuple[int, int]:
+        index, count = self.shard or (0, 1)
+        info = get_worker_info()
+        if info is None:
+            return index, count
+        return index * info.num_workers + info.id, count * info.num_workers
+
+    def locations(self, shard: Tuple[int, int], rng: random.Random) -> Iterator[Any]:
+        index, count = shard
+        locations = (location for i, location in enumerate(iter_locations(self.storage)) if i % count == index)
+        if self.shuffle_buffer > 0:
+            locations = shuffled(locations, self.shuffle_buffer, rng)
+        return locations
+
+    def create_converter(self, rng: random.Random) -> MultiViewPanoConverter | RandomPoseConverter:
+        # created in worker processes, so that sampling grids are not copied between them
+        if self.pose_ranges is not None:
+            generator = torch.Generator().manual_seed(rng.getrandbits(63))
+            return RandomPoseConverter(self.size, *self.pose_ranges, self.batch_size, self.device, generator)
+        return MultiViewPanoConverter(self.size, self.poses, self.batch_size, self.device, self.cache)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        shard = self.worker_shard()
+        rng = random.Random(f"{self.seed}-{self.epoch}-{shard[0]}-{shard[1]}")
+        converter = self.create_converter(rng)
+        reader = PanoramaReader(self.storage.parent)
+        # memory budget is split between batch buffers and decoded panoramas waiting for their batches
+        buffers = BatchBuffers(self.batch_size, max_bytes=int(self.batch_memory) // 2)
+
+        # locations with missing panoramas are skipped
+        panoramas = (
+            (location, load_panorama(location["panorama"], reader, self.panorama_height)[0])
+            for location in self.locations(shard, rng)
+            if "panorama" in location and reader.exists(location["panorama"])
+        )
+        batches = batchedby(
+            panoramas,
+            key=lambda x: x[1].shape,
+            n=self.batch_size,
+            max_size=int(self.batch_memory) // 2,
+            size=lambda x: x[1].nbytes,
+        )
+
+        for batch in batches:
+            locations, images = zip(*batch)
+            pano_batch = buffers.stack(images)
+            if isinstance(converter, RandomPoseConverter):
+                views, poses = converter.convert(pano_batch)
+                views, poses = views.unsqueeze(1), poses.float().unsqueeze(1)
+            else:
+                views = converter.convert(pano_batch)
+                poses = torch.tensor(self.poses, dtype=torch.float).expand(len(locations), -1, -1)
+
+            for location, location_views, location_poses in zip(locations, views.cpu(), poses):
+                metadata = location["metadata"]
+                country = country_codes_to_index.get(metadata.get("country_code"), -1)
+                for view, pose in zip(location_views, location_poses):
+                    # views are copied, so that items do not keep the whole batch in memory
+                    yield {
+                        "image": view.clone(),
+                        "pose": pose.clone(),
+                        "lat": metadata["lat"],
+                        "lng": metadata["lng"],
+                        "country": country,
+                    }
@@ -1,2 +1,12 @@
-from .calls import get_metadata, get_tile, single_image_search
-from .panorama import get_pano
+from .cache import MetadataCache, get_metadata_cache, set_metadata_cache
+from .calls import (
+    decode_tile,
+    get_base_urls,
+    get_metadata,
+    get_tile,
+    get_tile_bytes,
+    set_base_urls,
+    single_image_search,
+)
+from .panorama import get_pano, get_pano_size, get_pano_tiles, stitch_tiles
+from .ratelimit import RateLimiter, get_rate_limiter, set_rate_limiter
@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import *
+
+import orjson
+
+
+class MetadataCache:
+    def __init__(
+        self,
+        path: str | Path,
+        ttl: Optional[float] = 30 * 24 * 3600,
+        max_entries: Optional[int] = 10_000_000,
+        precision: int = 6,
+    ) -> None:
+        # ttl is in seconds, precision is number of decimal places lat/lng are rounded to in keys
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+        self._counters_lock = threading.Lock()
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+        self._n_puts = 0
+
+        # eviction scans the whole table, so it runs in background thread with its own connection
+        self._evictor = ThreadPoolExecutor(1)
+        self._eviction: Optional[Future] = None
+        self._evict_connection: Optional[sqlite3.Connection] = None
+
+    def search_key(self, lat: float, lng: float, radius: float) -> str:
+        return f"search:{round(lat, self.precision)}:{round(lng, self.precision)}:{radius}"
+
+    def metadata_key(self, panoid: str) -> str:
+        return f"metadata:{panoid}"
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self.connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            with self._counters_lock:
+                self.counters["expired"] += 1
+            row = None
+        if row is None:
+            self.counters["misses"] += 1
+            return None
+
+        self.counters["hits"] += 1
+        self.connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return orjson.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, orjson.dumps(value), now, now),
+        )
+        self._n_puts += 1
+        # counting rows is not free, so size is checked only once in a while
+        if self.max_entries is not None and self._n_puts % 1000 == 0:
+            if self._eviction is None or self._eviction.done():
+                self._eviction = self._evictor.submit(self._evict_in_background)
+
+    def evict(self, connection: Optional[sqlite3.Connection] = None) -> None:
+        connection = connection or self.connection
+        expired = evicted = 0
+        if self.ttl is not None:
+            cursor = connection.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+            expired = cursor.rowcount
+        if self.max_entries is not None:
+            (n_entries,) = connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+            if n_entries > self.max_entries:
+                cursor = connection.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                    (n_entries - self.max_entries,),
+                )
+                evicted = cursor.rowcount
+        with self._counters_lock:
+            self.counters["expired"] += expired
+            self.counters["evicted"] += evicted
+
+    def _evict_in_background(self) -> None:
+        if self._evict_connection is None:
+            self._evict_connection = sqlite3.connect(self.path, isolation_level=None)
+        self.evict(self._evict_connection)
+
+    def _close_evict_connection(self) -> None:
+        if self._evict_connection is not None:
+            self._evict_connection.close()
+
+    def close(self) -> None:
+        self._evictor.submit(self._close_evict_connection)
+        self._evictor.shutdown()
+        self.evict()
+        self.connection.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+_metadata_cache: Optional[MetadataCache] = None
+
+
+def get_metadata_cache() -> Optional[MetadataCache]:
+    return _metadata_cache
+
+
+def set_metadata_cache(cache: Optional[MetadataCache]) -> None:
+    global _metadata_cache
+    _metadata_cache = cache
@@ -1,5 +1,6 @@
 import asyncio
 import io
+import time
 import traceback
 from typing import *
 
@@ -7,13 +8,62 @@ import aiohttp
 import orjson
 from PIL import Image
 
-from aigeo.utils import safe_index
+from aigeo.utils import get_metrics, safe_index
+
+from .cache import get_metadata_cache
+from .ratelimit import RateLimiter, get_rate_limiter
+
+DEFAULT_API_URL = "https://maps.googleapis.com"
+DEFAULT_TILES_URL = "https://streetviewpixels-pa.googleapis.com"
+
+_api_url = DEFAULT_API_URL
+_tiles_url = DEFAULT_TILES_URL
+
+
+def get_base_urls() -> Tuple[str, str]:
+    return _api_url, _tiles_url
+
+
+def set_base_urls(api_url: Optional[str] = None, tiles_url: Optional[str] = None) -> None:
+    # e.g. for pointing calls to a local mock server, None is for Google API
+    global _api_url, _tiles_url
+    _api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+    _tiles_url = (tiles_url or DEFAULT_TILES_URL).rstrip("/")
+
+
+IN_BAND_ERRORS = [
+    "Internal error encountered.",
+    "The service is currently unavailable.",
+    "Unrecoverable data loss or corruption.",
+]
+
+
+def parse_json(text: str) -> Optional[Any]:
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return None
+
+
+def record_request(
+    limiter: RateLimiter, call: str, status: Optional[int], latency: float, throttled: bool = False
+) -> None:
+    # status is None for connection errors and timeouts, throttled is for errors reported in response body
+    limiter.record(status, latency, throttled)
+    metrics = get_metrics()
+    metrics.inc("requests_total", call=call, status="throttled" if throttled else status or "error")
+    metrics.observe("request_seconds", latency, call=call)
 
 
 async def single_image_search(
-    session: aiohttp.ClientSession, lat: float, lng: float, radius: float = 100, n_retries: int = 3
+    session: aiohttp.ClientSession,
+    lat: float,
+    lng: float,
+    radius: float = 100,
+    n_retries: int = 3,
+    limiter: Optional[RateLimiter] = None,
 ) -> Any:
-    url = "https://maps.googleapis.com/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/SingleImageSearch"
+    url = f"{_api_url}/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/SingleImageSearch"
     headers = {"x-user-agent": "grpc-web-javascript/0.1", "content-type": "application/json+protobuf"}
     body = (
         '[["apiv3", null, null, null, "US", null, null, null, null, null, [[false]]], '
@@ -21,24 +71,39 @@ async def single_image_search(
         + "null, [2], null, [[[2, true, 2], [3, true, 2], [10, true, 2]]]], [[1, 2, 3, 4, 8, 6]]]"
     )
 
+    cache = get_metadata_cache()
+    if cache is not None:
+        cache_key = cache.search_key(lat, lng, radius)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    limiter = limiter or get_rate_limiter()
     latest_error_message = ""
-    for _ in range(n_retries):
+    for attempt in range(n_retries):
+        if attempt > 0:
+            get_metrics().inc("retries_total", call="single_image_search")
+            await limiter.backoff(attempt)
+        await limiter.acquire()
+        start = time.monotonic()
         try:
             async with session.post(url=url, headers=headers, data=body.encode("utf-8")) as response:
+                latency = time.monotonic() - start
                 text = await response.text()
+                get_metrics().inc("downloaded_bytes_total", len(text), call="single_image_search")
+                # errors and throttling come in-band with status 200, response is classified before it is recorded
+                data = parse_json(text) if response.ok else None
+                error = data[1] if isinstance(data, list) and len(data) == 2 and data[1] in IN_BAND_ERRORS else None
+                record_request(limiter, "single_image_search", response.status, latency, throttled=error is not None)
                 if response.status in [400, 404]:
                     raise RuntimeError(f"single_image_search returned {response.status}. message: {text}")
+                if error is not None:
+                    latest_error_message = error
+                    continue
 
                 if response.ok:
-                    data = orjson.loads(text)
-                    if len(data) == 2:
-                        if data[1] in [
-                            "Internal error encountered.",
-                            "The service is currently unavailable.",
-                            "Unrecoverable data loss or corruption.",
-                        ]:
-                            latest_error_message = data[1]
-                            continue
+                    if data is None:
+                        raise RuntimeError(f"single_image_search returned invalid JSON: {text}")
                     if len(data) == 1 and len(data[0]) >= 3 and data[0][2] == "Search returned no images.":
                         raise RuntimeError(f"single_image_search failed with message: {data[0][2]}")
 
@@ -72,27 +137,47 @@ async def single_image_search(
                     result["lat"] = safe_index(data, [1, 5, 0, 1, 0, 2]) or lat
                     result["lng"] = safe_index(data, [1, 5, 0, 1, 0, 3]) or lng
 
+                    if cache is not None:
+                        cache.put(cache_key, result)
                     return result
                 else:
                     latest_error_message = text
         except (aiohttp.ClientConnectionError, asyncio.exceptions.TimeoutError):
+            record_request(limiter, "single_image_search", None, time.monotonic() - start)
             latest_error_message = traceback.format_exc()
 
     raise RuntimeError(f"single_image_search failed after {n_retries} retries. error: {latest_error_message}")
 
 
-async def get_metadata(session: aiohttp.ClientSession, panoid: str, n_retries: int = 3) -> Any:
-    url = "https://maps.googleapis.com/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/GetMetadata"
+async def get_metadata(
+    session: aiohttp.ClientSession, panoid: str, n_retries: int = 3, limiter: Optional[RateLimiter] = None
+) -> Any:
+    url = f"{_api_url}/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/GetMetadata"
     body = (
         f'[["apiv3",null,null,null,"US",null,null,null,null,null,[[0]]],["en","US"],[[[2,"{panoid}"]]],[[1,2,3,4,8,6]]]'
     )
     headers = {"x-user-agent": "grpc-web-javascript/0.1", "content-type": "application/json+protobuf"}
 
+    cache = get_metadata_cache()
+    if cache is not None:
+        cache_key = cache.metadata_key(panoid)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    limiter = limiter or get_rate_limiter()
     latest_error_message = ""
-    for _ in range(n_retries):
+    for attempt in range(n_retries):
+        if attempt > 0:
+            get_metrics().inc("retries_total", call="get_metadata")
+            await limiter.backoff(attempt)
+        await limiter.acquire()
+        start = time.monotonic()
         try:
             async with session.post(url=url, headers=headers, data=body.encode("utf-8")) as response:
+                record_request(limiter, "get_metadata", response.status, time.monotonic() - start)
                 text = await response.text()
+                get_metrics().inc("downloaded_bytes_total", len(text), call="get_metadata")
                 if response.status in [400, 404]:
                     raise RuntimeError(f"get_metadata returned {response.status}. message: {text}")
 
@@ -117,10 +202,13 @@ async def get_metadata(session: aiohttp.ClientSession, panoid: str, n_retries: i
                     result["lat"] = safe_index(data, [1, 0, 5, 0, 1, 0, 2], raise_on_error=True)
                     result["lng"] = safe_index(data, [1, 0, 5, 0, 1, 0, 3], raise_on_error=True)
 
+                    if cache is not None:
+                        cache.put(cache_key, result)
                     return result
                 else:
                     latest_error_message = text
         except (aiohttp.ClientConnectionError, asyncio.exceptions.TimeoutError):
+            record_request(limiter, "get_metadata", None, time.monotonic() - start)
             latest_error_message = traceback.format_exc()
 
     raise RuntimeError(f"get_metadata failed after {n_retries} retries. error: {latest_error_message}")
@@ -138,31 +226,60 @@ MEDIA_TYPE_TO_EXTENSION = {
 }
 
 
-async def get_tile(
-    session: aiohttp.ClientSession, panoid: str, x: int, y: int, zoom: int, n_retries: int = 3
-) -> Image.Image:
-    url = (
-        "https://streetviewpixels-pa.googleapis.com"
-        + f"/v1/tile?cb_client=maps_sv.tactile&panoid={panoid}&x={x}&y={y}&zoom={zoom}&nbt=1&fover=2"
-    )
+async def get_tile_bytes(
+    session: aiohttp.ClientSession,
+    panoid: str,
+    x: int,
+    y: int,
+    zoom: int,
+    n_retries: int = 3,
+    limiter: Optional[RateLimiter] = None,
+) -> Tuple[bytes, str]:
+    url = _tiles_url + f"/v1/tile?cb_client=maps_sv.tactile&panoid={panoid}&x={x}&y={y}&zoom={zoom}&nbt=1&fover=2"
     headers = {
         "accept": "image/jpeg,image/png,image/*;q=0.9,*/*;q=0.8",
         "referer": "https://www.google.com/",
     }
 
+    limiter = limiter or get_rate_limiter()
     latest_error_message = ""
-    for _ in range(n_retries):
+    for attempt in range(n_retries):
+        if attempt > 0:
+            get_metrics().inc("retries_total", call="get_tile")
+            await limiter.backoff(attempt)
+        await limiter.acquire()
+        start = time.monotonic()
         try:
             async with session.get(url=url, headers=headers) as response:
+                record_request(limiter, "get_tile", response.status, time.monotonic() - start)
                 if response.status in [400, 404]:
                     raise RuntimeError(f"get_tile returned {response.status}. message: {await response.text()}")
 
                 if response.ok:
                     ext = MEDIA_TYPE_TO_EXTENSION[response.headers["Content-Type"]]
-                    return Image.open(io.BytesIO(await response.content.read()), formats=[ext])
+                    data = await response.content.read()
+                    get_metrics().inc("downloaded_bytes_total", len(data), call="get_tile")
+                    return data, ext
                 else:
                     latest_error_message = await response.text()
         except (aiohttp.ClientConnectionError, asyncio.exceptions.TimeoutError):
+            record_request(limiter, "get_tile", None, time.monotonic() - start)
             latest_error_message = traceback.format_exc()
 
     raise RuntimeError(f"get_tile failed after {n_retries} retries. error: {latest_error_message}")
+
+
+def decode_tile(data: bytes, ext: str) -> Image.Image:
+    return Image.open(io.BytesIO(data), formats=[ext])
+
+
+async def get_tile(
+    session: aiohttp.ClientSession,
+    panoid: str,
+    x: int,
+    y: int,
+    zoom: int,
+    n_retries: int = 3,
+    limiter: Optional[RateLimiter] = None,
+) -> Image.Image:
+    return decode_tile(*await get_tile_bytes(session, panoid, x, y, zoom, n_retries, limiter))
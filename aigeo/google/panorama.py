@@ -1,17 +1,22 @@
 import asyncio
-import itertools
 import math
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import aiohttp
 import numpy as np
 from PIL import Image
 
-from .calls import get_tile
+from aigeo.utils import get_metrics, limited
 
+from .calls import decode_tile, get_tile_bytes
 
-def concat_grid(arrays: List[List[np.ndarray]]) -> np.ndarray:
-    return np.concatenate([np.concatenate(row, axis=1) for row in arrays], axis=0)
+
+def decode_tile_into(data: bytes, ext: str, buffer: np.ndarray, top: int, left: int) -> None:
+    with get_metrics().timer("decode_seconds", stage="tile"), decode_tile(data, ext) as tile:
+        if tile.mode != "RGB":
+            tile = tile.convert("RGB")
+        region = buffer[top : top + tile.height, left : left + tile.width]
+        region[...] = np.asarray(tile)[: region.shape[0], : region.shape[1]]
 
 
 async def get_hires_tile(
@@ -22,25 +27,77 @@ async def get_hires_tile(
     w: int,
     h: int,
     zoom: int,
+    tile_size: Tuple[int, int],
+    limiter: Optional[asyncio.Semaphore] = None,
+    out_size: Optional[Tuple[int, int]] = None,
 ) -> np.ndarray:
-    tasks = [get_tile(session, panoid, x + dx, y + dy, zoom) for dy in range(h) for dx in range(w)]
-    tiles = await asyncio.gather(*tasks)
-    grid = list(itertools.batched(tiles, w))
-    return concat_grid(grid)
+    # tiles are decoded in a thread pool straight into their place in a single buffer,
+    # tiles out of out_size are not loaded, the ones on its border are cut
+    tile_h, tile_w = tile_size
+    height, width = out_size or (h * tile_h, w * tile_w)
+    buffer = np.zeros((height, width, 3), dtype=np.uint8)
+    loop = asyncio.get_running_loop()
+
+    async def load_tile(dx: int, dy: int) -> None:
+        with get_metrics().track("tiles_pending"):
+            data, ext = await limited(limiter, get_tile_bytes(session, panoid, x + dx, y + dy, zoom))
+        await loop.run_in_executor(None, decode_tile_into, data, ext, buffer, dy * tile_h, dx * tile_w)
+
+    tasks = [load_tile(dx, dy) for dy in range(h) for dx in range(w) if dy * tile_h < height and dx * tile_w < width]
+    await asyncio.gather(*tasks)
+    return buffer
 
 
 def get_dimenstions(size: Tuple[int, int], tile_size: Tuple[int, int]) -> Tuple[int, int]:
     return math.ceil(size[1] / tile_size[1]), math.ceil(size[0] / tile_size[0])
 
 
+def get_pano_size(size: Tuple[int, int], tile_size: Tuple[int, int]) -> Tuple[int, int]:
+    w, h = get_dimenstions(size, tile_size)
+    return min(size[0], h * tile_size[0]), min(2 * size[0], w * tile_size[1])
+
+
+async def get_pano_tiles(
+    session: aiohttp.ClientSession,
+    panoid: str,
+    sizes: List[Tuple[int, int]],
+    tile_size: Tuple[int, int],
+    zoom: int,
+    limiter: Optional[asyncio.Semaphore] = None,
+) -> Tuple[Dict[Tuple[int, int], Tuple[bytes, str]], Tuple[int, int]]:
+    # raw (not decoded) tiles of panorama keyed by (x, y), and (height, width) of panorama
+    size = sizes[zoom]
+    w, h = get_dimenstions(size, tile_size)
+    height, width = get_pano_size(size, tile_size)
+    coords = [(x, y) for y in range(h) for x in range(w) if y * tile_size[0] < height and x * tile_size[1] < width]
+
+    async def load_tile(x: int, y: int) -> Tuple[bytes, str]:
+        with get_metrics().track("tiles_pending"):
+            return await limited(limiter, get_tile_bytes(session, panoid, x, y, zoom))
+
+    tiles = await asyncio.gather(*[load_tile(x, y) for x, y in coords])
+    return dict(zip(coords, tiles)), (height, width)
+
+
+def stitch_tiles(
+    tiles: Dict[Tuple[int, int], Tuple[bytes, str]], size: Tuple[int, int], tile_size: Tuple[int, int]
+) -> np.ndarray:
+    buffer = np.zeros((*size, 3), dtype=np.uint8)
+    with get_metrics().timer("stitch_seconds"):
+        for (x, y), (data, ext) in tiles.items():
+            decode_tile_into(data, ext, buffer, y * tile_size[0], x * tile_size[1])
+    return buffer
+
+
 async def get_pano(
     session: aiohttp.ClientSession,
     panoid: str,
     sizes: List[Tuple[int, int]],
-    tile_size: Tuple[float, float],
+    tile_size: Tuple[int, int],
     zoom: int,
+    limiter: Optional[asyncio.Semaphore] = None,
 ) -> Image.Image:
     size = sizes[zoom]
     w, h = get_dimenstions(size, tile_size)
-    pano = await get_hires_tile(session, panoid, 0, 0, w, h, zoom)
-    return Image.fromarray(pano[: size[0], : 2 * size[0], ...])
+    pano = await get_hires_tile(session, panoid, 0, 0, w, h, zoom, tile_size, limiter, get_pano_size(size, tile_size))
+    return Image.fromarray(pano)
@@ -0,0 +1,116 @@
+import asyncio
+import random
+import time
+from typing import *
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rate: float = 0,
+        burst: float = 1,
+        adaptive: bool = False,
+        min_rate: float = 1,
+        max_rate: float = 1000,
+        increase: float = 1,
+        decrease: float = 0.5,
+        latency_threshold: Optional[float] = None,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+    ) -> None:
+        # rate is in requests per second, 0 means unlimited (adaptive mode starts from min_rate then)
+        if adaptive and min_rate <= 0:
+            raise ValueError(f"min_rate must be positive in adaptive mode, got {min_rate}")
+        if adaptive and rate <= 0:
+            rate = min_rate
+
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "slow": 0,
+            "rate_decreases": 0,
+            "wait_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self) -> None:
+        self.counters["requests"] += 1
+        if self.rate <= 0:
+            return
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                self.counters["wait_seconds"] += delay
+                await asyncio.sleep(delay)
+                self._tokens = 1
+                self._last_refill = time.monotonic()
+            self._tokens -= 1
+
+    async def backoff(self, attempt: int) -> None:
+        # exponential backoff with full jitter, attempt starts from 1 for the first retry
+        self.counters["retries"] += 1
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        self.counters["backoff_seconds"] += delay
+        await asyncio.sleep(delay)
+
+    def record(self, status: Optional[int], latency: float, throttled: bool = False) -> None:
+        # status is None for connection errors and timeouts, throttled is for errors reported in response body
+        if throttled or status is None or status == 429 or status >= 500:
+            self.throttle(latency)
+        elif self.latency_threshold is not None and latency > self.latency_threshold:
+            self.counters["slow"] += 1
+            self._slow_down(latency)
+        elif self.adaptive:
+            # additive increase of about `increase` requests per second every second
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttle(self, latency: float) -> None:
+        self.counters["throttled"] += 1
+        self._slow_down(latency)
+
+    def _slow_down(self, latency: float) -> None:
+        if not self.adaptive:
+            return
+        # requests sent before the last decrease do not reflect the decreased rate yet,
+        # so one burst of in-flight failures decreases the rate only once
+        now = time.monotonic()
+        if now - latency < self._last_decrease:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.counters["rate_decreases"] += 1
+
+
+_rate_limiter = RateLimiter()
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _rate_limiter
+
+
+def set_rate_limiter(limiter: RateLimiter) -> None:
+    global _rate_limiter
+    _rate_limiter = limiter
@@ -0,0 +1,15 @@
+from .manifest import PanoramaManifest
+from .shards import INDEX_FILENAME, PanoramaReader, ShardStore, is_shard_store
+from .tile_archive import TILE_ARCHIVE_EXTENSION, TileArchive, is_tile_archive, write_tile_archive
+
+__all__ = [
+    TILE_ARCHIVE_EXTENSION,
+    TileArchive,
+    is_tile_archive,
+    write_tile_archive,
+    INDEX_FILENAME,
+    ShardStore,
+    PanoramaReader,
+    is_shard_store,
+    PanoramaManifest,
+]
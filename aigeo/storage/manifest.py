@@ -0,0 +1,40 @@
+import threading
+from pathlib import Path
+from typing import *
+
+from aigeo.utils import append_json_line, iter_json_lines, open_json_lines_for_append
+
+
+# append-only JSON lines file of panoramas known to be readable, their existence is not checked again
+class PanoramaManifest:
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.known: Set[str] = set()
+
+        if self.path.exists():
+            for entry in iter_json_lines(self.path, skip_invalid=True):
+                self.known.add(entry["panorama"])
+
+        self._lock = threading.Lock()
+        self.file = open_json_lines_for_append(self.path)
+
+    def __contains__(self, rel_path: str) -> bool:
+        return rel_path in self.known
+
+    def __len__(self) -> int:
+        return len(self.known)
+
+    def add(self, rel_path: str) -> None:
+        with self._lock:
+            if rel_path not in self.known:
+                self.known.add(rel_path)
+                append_json_line(self.file, {"panorama": rel_path})
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
@@ -0,0 +1,119 @@
+import io
+import mmap
+import threading
+from pathlib import Path
+from typing import *
+
+from aigeo.utils import append_json_line, iter_json_lines, open_json_lines_for_append
+
+INDEX_FILENAME = "index.jsonl"
+
+
+def is_shard_store(path: str | Path) -> bool:
+    return (Path(path) / INDEX_FILENAME).exists()
+
+
+# directory of large append-only shard files and JSON lines index of blobs: key -> (shard, offset, length)
+class ShardStore:
+    def __init__(self, path: str | Path, max_shard_bytes: int = 4 * 2**30) -> None:
+        self.path = Path(path)
+        self.max_shard_bytes = max_shard_bytes
+        self.index: Dict[str, Tuple[int, int, int]] = {}
+
+        self._lock = threading.Lock()
+        self._index_file: Optional[BinaryIO] = None
+        self._shard_file: Optional[BinaryIO] = None
+        self._shard = 0
+        self._maps: Dict[int, mmap.mmap] = {}
+
+        index_path = self.path / INDEX_FILENAME
+        if index_path.exists():
+            for entry in iter_json_lines(index_path, skip_invalid=True):
+                self.index[entry["key"]] = (entry["shard"], entry["offset"], entry["length"])
+                self._shard = max(self._shard, entry["shard"])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def shard_path(self, shard: int) -> Path:
+        return self.path / f"shard-{shard:05d}.bin"
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._lock:
+            if self._index_file is None:
+                self._open_for_writing()
+            if self._shard_file.tell() > 0 and self._shard_file.tell() + len(data) > self.max_shard_bytes:
+                self._shard_file.close()
+                self._shard += 1
+                self._shard_file = open(self.shard_path(self._shard), "ab")
+
+            # blob is flushed before its index entry, so a crash never leaves an entry pointing to missing data
+            offset = self._shard_file.tell()
+            self._shard_file.write(data)
+            self._shard_file.flush()
+            entry = {"key": key, "shard": self._shard, "offset": offset, "length": len(data)}
+            append_json_line(self._index_file, entry)
+            self.index[key] = (self._shard, offset, len(data))
+
+    def get(self, key: str) -> memoryview:
+        shard, offset, length = self.index[key]
+        with self._lock:
+            mapping = self._maps.get(shard)
+            if mapping is None or len(mapping) < offset + length:
+                # shard has grown since it was mapped, old mapping is released together with its memoryviews
+                with open(self.shard_path(shard), "rb") as f:
+                    mapping = self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapping)[offset : offset + length]
+
+    def open(self, key: str) -> BinaryIO:
+        return io.BytesIO(self.get(key))
+
+    def close(self) -> None:
+        with self._lock:
+            for f in [self._index_file, self._shard_file]:
+                if f is not None:
+                    f.close()
+            self._index_file = self._shard_file = None
+            self._maps.clear()
+
+    def _open_for_writing(self) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index_file = open_json_lines_for_append(self.path / INDEX_FILENAME)
+        self._shard_file = open(self.shard_path(self._shard), "ab")
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class PanoramaReader:
+    def __init__(self, storage_dir: str | Path) -> None:
+        self.storage_dir = Path(storage_dir)
+        self._stores: Dict[Path, Optional[ShardStore]] = {}
+        self._lock = threading.Lock()
+
+    def store(self, rel_path: str | Path) -> Optional[ShardStore]:
+        # panoramas in shard store have paths "<store directory>/<key>"
+        directory = Path(rel_path).parent
+        with self._lock:
+            if directory not in self._stores:
+                path = self.storage_dir / directory
+                self._stores[directory] = ShardStore(path) if is_shard_store(path) else None
+            return self._stores[directory]
+
+    def exists(self, rel_path: str | Path) -> bool:
+        store = self.store(rel_path)
+        if store is None:
+            return (self.storage_dir / rel_path).exists()
+        return Path(rel_path).name in store
+
+    def open(self, rel_path: str | Path) -> Path | BinaryIO:
+        store = self.store(rel_path)
+        if store is None:
+            return self.storage_dir / rel_path
+        return store.open(Path(rel_path).name)
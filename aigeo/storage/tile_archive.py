@@ -0,0 +1,73 @@
+import io
+import math
+import zipfile
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import orjson
+from PIL import Image
+
+TILE_ARCHIVE_EXTENSION = ".zip"
+
+
+def is_tile_archive(path: str | Path) -> bool:
+    return str(path).endswith(TILE_ARCHIVE_EXTENSION)
+
+
+def write_tile_archive(
+    path: str | Path | BinaryIO,
+    tiles: Dict[Tuple[int, int], Tuple[bytes, str]],
+    size: Tuple[int, int],
+    tile_size: Tuple[int, int],
+) -> None:
+    # tiles are stored as is (without recompression), keyed by (x, y) position in grid,
+    # size is (height, width) of panorama, tiles on its right and bottom border are cut when reading
+    layout = {
+        "size": list(size),
+        "tile_size": list(tile_size),
+        "tiles": {f"{x}_{y}": f"{x}_{y}.{ext}" for (x, y), (_, ext) in tiles.items()},
+    }
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        archive.writestr("layout.json", orjson.dumps(layout))
+        for (x, y), (data, ext) in tiles.items():
+            archive.writestr(f"{x}_{y}.{ext}", data)
+
+
+class TileArchive:
+    def __init__(self, path: str | Path | BinaryIO) -> None:
+        self.archive = zipfile.ZipFile(path, "r")
+        layout = orjson.loads(self.archive.read("layout.json"))
+        self.size: Tuple[int, int] = tuple(layout["size"])
+        self.tile_size: Tuple[int, int] = tuple(layout["tile_size"])
+        self.tiles: Dict[str, str] = layout["tiles"]
+
+    def read(self, box: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        # decodes only tiles intersecting box=(left, top, right, bottom), result is (H, W, 3) uint8
+        height, width = self.size
+        tile_h, tile_w = self.tile_size
+        left, top, right, bottom = box or (0, 0, width, height)
+
+        result = np.zeros((bottom - top, right - left, 3), dtype=np.uint8)
+        for y in range(top // tile_h, math.ceil(bottom / tile_h)):
+            for x in range(left // tile_w, math.ceil(right / tile_w)):
+                name = self.tiles.get(f"{x}_{y}")
+                if name is None:
+                    continue
+                with Image.open(io.BytesIO(self.archive.read(name))) as tile:
+                    if tile.mode != "RGB":
+                        tile = tile.convert("RGB")
+                    y0, y1 = max(top, y * tile_h), min(bottom, y * tile_h + tile.height)
+                    x0, x1 = max(left, x * tile_w), min(right, x * tile_w + tile.width)
+                    region = np.asarray(tile)[y0 - y * tile_h : y1 - y * tile_h, x0 - x * tile_w : x1 - x * tile_w]
+                    result[y0 - top : y1 - top, x0 - left : x1 - left] = region
+        return result
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
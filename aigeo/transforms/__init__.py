@@ -1,5 +1,18 @@
-from .pano_converter import PanoConverter
+from .grid_cache import GridCache, default_grid_cache
+from .loading import BatchBuffers, load_panorama, load_panorama_region, resize_panorama
+from .pano_converter import MultiViewPanoConverter, PanoConverter, RandomPoseConverter
+from .poses import cubemap_poses, heading_poses
 
 __all__ = [
     PanoConverter,
+    MultiViewPanoConverter,
+    RandomPoseConverter,
+    heading_poses,
+    cubemap_poses,
+    GridCache,
+    default_grid_cache,
+    resize_panorama,
+    load_panorama,
+    load_panorama_region,
+    BatchBuffers,
 ]
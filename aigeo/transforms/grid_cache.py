@@ -0,0 +1,79 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import torch
+
+GridKey = Tuple[int, float, float, float]
+
+
+class GridCache:
+    def __init__(self, max_bytes: int = 256 * 2**20, cache_dir: Optional[str | Path] = None) -> None:
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._grids: OrderedDict[GridKey, torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: GridKey, factory: Callable[[], torch.Tensor]) -> torch.Tensor:
+        with self._lock:
+            if key in self._grids:
+                self.hits += 1
+                self._grids.move_to_end(key)
+                return self._grids[key]
+            self.misses += 1
+
+        grid = self._load(key)
+        if grid is None:
+            grid = factory().cpu()
+            self._store(key, grid)
+
+        with self._lock:
+            if key not in self._grids:
+                self._grids[key] = grid
+                self.n_bytes += grid.nbytes
+                self._evict()
+        return grid
+
+    def clear(self) -> None:
+        with self._lock:
+            self._grids.clear()
+            self.n_bytes = 0
+
+    def _evict(self) -> None:
+        while self.n_bytes > self.max_bytes and len(self._grids) > 1:
+            _, grid = self._grids.popitem(last=False)
+            self.n_bytes -= grid.nbytes
+
+    def _path(self, key: GridKey) -> Path:
+        size, phi, theta, fov = key
+        return self.cache_dir / f"{size}_{phi.hex()}_{theta.hex()}_{fov.hex()}.npy"
+
+    def _load(self, key: GridKey) -> Optional[torch.Tensor]:
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        if not path.exists():
+            return None
+        # copy-on-write mapping keeps the file untouched, while torch gets a writable array
+        return torch.from_numpy(np.load(path, mmap_mode="c"))
+
+    def _store(self, key: GridKey, grid: torch.Tensor) -> None:
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so concurrent processes never read a partial grid
+        fd, tmp_path = tempfile.mkstemp(suffix=".npy", dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, grid.numpy())
+        os.replace(tmp_path, self._path(key))
+
+
+default_grid_cache = GridCache()
@@ -0,0 +1,100 @@
+import math
+from collections import OrderedDict
+from typing import *
+
+import numpy as np
+import torch
+from PIL import Image
+
+from aigeo.storage import PanoramaReader, TileArchive, is_tile_archive
+
+from .pano_converter import MultiViewPanoConverter
+
+
+def resize_panorama(image: Image.Image, height: Optional[int]) -> Image.Image:
+    # panoramas of different resolutions are brought to the same height (keeping aspect ratio),
+    # so that they can be converted in the same batches
+    if height is None or image.height == height:
+        return image
+    width = round(image.width * height / image.height)
+    # JPEG is decoded at reduced scale when possible
+    image.draft(image.mode, (width, height))
+    return image.resize((width, height), Image.Resampling.BILINEAR)
+
+
+def load_panorama(path: str, reader: PanoramaReader, height: Optional[int] = None) -> Tuple[torch.Tensor, Any]:
+    # panorama is kept as (H, W, C) uint8, it is transposed while copying into a batch buffer
+    source = reader.open(path)
+    if is_tile_archive(path):
+        with TileArchive(source) as archive:
+            if height is None:
+                return torch.from_numpy(archive.read()), None
+            image = Image.fromarray(archive.read())
+    else:
+        image = Image.open(source)
+    return torch.from_numpy(np.atleast_3d(np.array(resize_panorama(image, height)))), None
+
+
+def load_panorama_region(
+    path: str, reader: PanoramaReader, converter: MultiViewPanoConverter, height: Optional[int] = None
+) -> Tuple[torch.Tensor, Any]:
+    source = reader.open(path)
+    if is_tile_archive(path):
+        with TileArchive(source) as archive:
+            if height is None:
+                # only tiles seen by camera are decoded
+                height, width = archive.size
+                box = converter.crop_box(height, width)
+                return torch.from_numpy(archive.read(box)), (box, (height, width))
+            image = resize_panorama(Image.fromarray(archive.read()), height)
+    else:
+        image = Image.open(source)
+        if height is None:
+            # JPEG can be decoded at reduced scale, as long as it is not coarser than the sampling grid
+            width, height = image.size
+            reduce = converter.max_reduce(height, width)
+            if reduce >= 2:
+                image.draft(image.mode, (math.ceil(width / reduce), math.ceil(height / reduce)))
+        else:
+            image = resize_panorama(image, height)
+
+    width, height = image.size
+    box = converter.crop_box(height, width)
+    region = torch.from_numpy(np.atleast_3d(np.array(image.crop(box))))
+    return region, (box, (height, width))
+
+
+# reusable (batch_size, C, H, W) uint8 buffers for stacking panoramas, one per panorama shape. Least recently used
+# buffers are dropped when all of them take more than max_bytes (the last used one is always kept)
+class BatchBuffers:
+    def __init__(self, batch_size: int, pin_memory: bool = False, max_bytes: int = 256 * 2**20) -> None:
+        self.batch_size = batch_size
+        self.pin_memory = pin_memory
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+
+        self._buffers: OrderedDict[Tuple[int, int, int], torch.Tensor] = OrderedDict()
+
+    def stack(self, images: Sequence[torch.Tensor]) -> torch.Tensor:
+        # images are (H, W, C), they are transposed while copying
+        if len(images) > self.batch_size:
+            raise ValueError("too many images for batch")
+        h, w, c = images[0].shape
+        key = (c, h, w)
+        if key in self._buffers:
+            self._buffers.move_to_end(key)
+        else:
+            buffer = torch.empty((self.batch_size, c, h, w), dtype=torch.uint8, pin_memory=self.pin_memory)
+            self._buffers[key] = buffer
+            self.n_bytes += buffer.nbytes
+            self._evict()
+
+        buffer = self._buffers[key]
+        for i, image in enumerate(images):
+            buffer[i].copy_(image.permute(2, 0, 1))
+        return buffer[: len(images)]
+
+    def _evict(self) -> None:
+        while self.n_bytes > self.max_bytes and len(self._buffers) > 1:
+            _, buffer = self._buffers.popitem(last=False)
+            self.n_bytes -= buffer.nbytes
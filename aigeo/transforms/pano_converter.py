@@ -1,58 +1,194 @@
+import math
 from typing import *
 
-import numpy as np
 import torch
 from torch.nn import functional as F
 
+from .grid_cache import GridCache, default_grid_cache
 
-def get_cube_center(phi: float, theta: float) -> np.ndarray:
-    return np.array([np.cos(phi) * np.cos(theta), np.sin(phi) * np.cos(theta), -np.sin(theta)])
 
+def get_cube_center(phi: torch.Tensor, theta: torch.Tensor) -> torch.Tensor:
+    return torch.stack(
+        [torch.cos(phi) * torch.cos(theta), torch.sin(phi) * torch.cos(theta), -torch.sin(theta)],
+        dim=-1,
+    )
 
-def calculate_support_vectors(phi: float, theta: float, fov: float) -> Tuple[np.ndarray, np.ndarray]:
+
+def calculate_support_vectors(
+    phi: torch.Tensor, theta: torch.Tensor, fov: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
     v = get_cube_center(phi, theta)
-    s = np.tan(fov / 2)
+    s = torch.tan(fov / 2)[..., None]
 
-    up = np.array([0, 0, 1])
-    if np.allclose(v, up):
-        up = np.array([1, 0, 0])
+    up = v.new_tensor([0, 0, 1]).expand_as(v)
+    up = torch.where(torch.isclose(v, up).all(dim=-1, keepdim=True), v.new_tensor([1, 0, 0]), up)
 
-    dj = -np.cross(v, up)
-    di = np.cross(v, dj)
+    dj = -torch.linalg.cross(v, up)
+    di = torch.linalg.cross(v, dj)
 
-    dj *= s / np.linalg.norm(dj)
-    di *= s / np.linalg.norm(di)
+    dj = dj * s / torch.linalg.norm(dj, dim=-1, keepdim=True)
+    di = di * s / torch.linalg.norm(di, dim=-1, keepdim=True)
 
     return di, dj
 
 
-def cube_to_3d(i: float, j: float, di: np.ndarray, dj: np.ndarray, v: np.ndarray) -> np.ndarray:
-    return v + di * (2 * i - 1) + dj * (2 * j - 1)
+def cube_to_3d(i: torch.Tensor, j: torch.Tensor, di: torch.Tensor, dj: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+    di, dj, v = di[..., None, None, :], dj[..., None, None, :], v[..., None, None, :]
+    return v + di * (2 * i[..., None] - 1) + dj * (2 * j[..., None] - 1)
 
 
-def cube_to_pano(i: float, j: float, di: np.ndarray, dj: np.ndarray, v: np.ndarray) -> Tuple[float, float]:
-    x, y, z = cube_to_3d(i, j, di, dj, v)
-    phi = np.atan2(y, x)
-    rsin = np.hypot(x, y)
-    theta = np.atan2(z, rsin)
-    ox = 2 * theta / np.pi
-    oy = phi / np.pi
+def cube_to_pano(
+    i: torch.Tensor, j: torch.Tensor, di: torch.Tensor, dj: torch.Tensor, v: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    x, y, z = cube_to_3d(i, j, di, dj, v).unbind(dim=-1)
+    phi = torch.atan2(y, x)
+    rsin = torch.hypot(x, y)
+    theta = torch.atan2(z, rsin)
+    ox = 2 * theta / torch.pi
+    oy = phi / torch.pi
     return ox, oy
 
 
-def prepare_base_mapping(size: int, phi: float, theta: float, fov: float, batch_size: int, device: str) -> torch.Tensor:
-    mapping = torch.zeros((batch_size, size, size, 2), dtype=torch.float, device=device)
+def prepare_mapping(size: int, phi: torch.Tensor, theta: torch.Tensor, fov: torch.Tensor) -> torch.Tensor:
+    # phi, theta and fov are tensors of shape (N,), the result is a mapping of shape (N, size, size, 2)
     di, dj = calculate_support_vectors(phi, theta, fov)
     v = get_cube_center(phi, theta)
-    for i in range(size):
-        for j in range(size):
-            xmap, ymap = cube_to_pano((i + 0.5) / size, (j + 0.5) / size, di, dj, v)
-            mapping[:, i, j, 0] = ymap
-            mapping[:, i, j, 1] = xmap
-    return mapping
+    coords = (torch.arange(size, dtype=phi.dtype, device=phi.device) + 0.5) / size
+    i, j = torch.meshgrid(coords, coords, indexing="ij")
+    xmap, ymap = cube_to_pano(i, j, di, dj, v)
+    return torch.stack([ymap, xmap], dim=-1)
+
+
+def prepare_base_mapping(size: int, phi: float, theta: float, fov: float, device: str) -> torch.Tensor:
+    pose = torch.tensor([[phi, theta, fov]], dtype=torch.float64)
+    return prepare_mapping(size, *pose.unbind(dim=-1)).float().to(device)
+
+
+def sample_panoramas(pano_batch: torch.Tensor, mapping: torch.Tensor) -> torch.Tensor:
+    if pano_batch.dtype.is_floating_point:
+        return F.grid_sample(pano_batch.to(mapping.device), mapping, align_corners=True)
+
+    # integer panoramas are converted to float on the mapping device and the result is cast back,
+    # on CPU one item at a time, so that only a single float panorama exists at once
+    pano_batch = pano_batch.to(mapping.device, non_blocking=True)
+    n_batches, n_channels = pano_batch.shape[:2]
+    chunk_size = 1 if mapping.device.type == "cpu" else n_batches
+    result = torch.empty((n_batches, n_channels, *mapping.shape[1:3]), dtype=pano_batch.dtype, device=mapping.device)
+    for i in range(0, n_batches, chunk_size):
+        chunk = slice(i, i + chunk_size)
+        result[chunk] = F.grid_sample(pano_batch[chunk].float(), mapping[chunk], align_corners=True)
+    return result
+
+
+def get_base_mapping(
+    size: int, phi: float, theta: float, fov: float, device: str, cache: Optional[GridCache] = None
+) -> torch.Tensor:
+    if cache is None:
+        return prepare_base_mapping(size, phi, theta, fov, device)
+    key = (size, float(phi), float(theta), float(fov))
+    return cache.get(key, lambda: prepare_base_mapping(size, phi, theta, fov, "cpu")).to(device)
+
+
+def prepare_multiview_mapping(
+    size: int, poses: Sequence[Tuple[float, float, float]], device: str, cache: Optional[GridCache] = None
+) -> torch.Tensor:
+    # views are stacked along the height axis, so that one grid_sample call reads each panorama only once
+    return torch.cat([get_base_mapping(size, phi, theta, fov, device, cache) for phi, theta, fov in poses], dim=1)
+
+
+def get_crop_box(mapping: torch.Tensor, height: int, width: int) -> Tuple[int, int, int, int]:
+    # (left, top, right, bottom) box of panorama pixels read by mapping, including bilinear neighbours
+    box = []
+    for k, length in [(0, width), (1, height)]:
+        coords = (mapping[..., k] + 1) / 2 * (length - 1)
+        start = max(math.floor(coords.min().item()), 0)
+        stop = min(math.floor(coords.max().item()) + 2, length)
+        box.append((min(start, max(stop - 2, 0)), stop))
+    (left, right), (top, bottom) = box
+    return left, top, right, bottom
+
+
+def crop_mapping(mapping: torch.Tensor, box: Tuple[int, int, int, int], height: int, width: int) -> torch.Tensor:
+    # maps normalized coordinates of the whole panorama to normalized coordinates of its crop
+    left, top, right, bottom = box
+    size = mapping.new_tensor([width - 1, height - 1])
+    crop_size = mapping.new_tensor([max(right - left - 1, 1), max(bottom - top - 1, 1)])
+    offset = mapping.new_tensor([left, top])
+    return ((mapping + 1) * size / 2 - offset) * 2 / crop_size - 1
+
+
+def get_max_reduce(mapping: torch.Tensor, height: int, width: int) -> float:
+    # smallest distance in panorama pixels between neighbouring points of mapping,
+    # panorama can be downscaled by this factor without losing sampled details
+    pixels = (mapping[0] + 1) / 2 * mapping.new_tensor([width - 1, height - 1])
+    steps = [
+        torch.linalg.norm(pixels[1:] - pixels[:-1], dim=-1).min(),
+        torch.linalg.norm(pixels[:, 1:] - pixels[:, :-1], dim=-1).min(),
+    ]
+    return max(min(step.item() for step in steps), 1.0)
+
+
+class MultiViewPanoConverter:
+    def __init__(
+        self,
+        size: int,
+        poses: Sequence[Tuple[float, float, float]],
+        batch_size: int,
+        device: Any = "cpu",
+        cache: Optional[GridCache] = default_grid_cache,
+    ) -> None:
+        if len(poses) == 0:
+            raise ValueError("expected at least one pose")
 
+        self.device = device
+        self.batch_size = batch_size
+        self.size = size
+        self.n_views = len(poses)
+
+        with torch.no_grad():
+            self.base_mapping = prepare_multiview_mapping(size, poses, device, cache).expand(batch_size, -1, -1, -1)
+
+        self._crop_boxes: Dict[Tuple[int, int], Tuple[int, int, int, int]] = {}
+        self._max_reduces: Dict[Tuple[int, int], float] = {}
+
+    @torch.no_grad()
+    def crop_box(self, height: int, width: int) -> Tuple[int, int, int, int]:
+        if (height, width) not in self._crop_boxes:
+            self._crop_boxes[height, width] = get_crop_box(self.base_mapping[:1], height, width)
+        return self._crop_boxes[height, width]
+
+    @torch.no_grad()
+    def max_reduce(self, height: int, width: int) -> float:
+        if (height, width) not in self._max_reduces:
+            self._max_reduces[height, width] = get_max_reduce(self.base_mapping[:1], height, width)
+        return self._max_reduces[height, width]
+
+    @torch.no_grad()
+    def convert(
+        self,
+        pano_batch: torch.Tensor,
+        box: Optional[Tuple[int, int, int, int]] = None,
+        pano_size: Optional[Tuple[int, int]] = None,
+    ) -> torch.Tensor:
+        # with box, pano_batch is expected to be cropped by it from panoramas of pano_size=(height, width)
+        if len(pano_batch.shape) != 4:
+            raise TypeError("expected pano shape to be (N, C, H, W)")
 
-class PanoConverter:
+        n_batches, n_channels = pano_batch.shape[:2]
+        if n_batches > self.batch_size:
+            raise TypeError("too many batches")
+
+        mapping = self.base_mapping[:n_batches, ...]
+        if box is not None:
+            if pano_size is None:
+                raise TypeError("expected pano_size for cropped panoramas")
+            mapping = crop_mapping(mapping, box, *pano_size)
+
+        views = sample_panoramas(pano_batch, mapping)
+        return views.view(n_batches, n_channels, self.n_views, self.size, self.size).transpose(1, 2)
+
+
+class PanoConverter(MultiViewPanoConverter):
     def __init__(
         self,
         size: int,
@@ -61,15 +197,46 @@ class PanoConverter:
         fov: float,
         batch_size: int,
         device: Any = "cpu",
+        cache: Optional[GridCache] = default_grid_cache,
+    ) -> None:
+        super().__init__(size, [(phi, theta, fov)], batch_size, device, cache)
+
+    @torch.no_grad()
+    def convert(
+        self,
+        pano_batch: torch.Tensor,
+        box: Optional[Tuple[int, int, int, int]] = None,
+        pano_size: Optional[Tuple[int, int]] = None,
+    ) -> torch.Tensor:
+        return super().convert(pano_batch, box, pano_size).squeeze(1)
+
+
+class RandomPoseConverter:
+    def __init__(
+        self,
+        size: int,
+        phi_range: Tuple[float, float],
+        theta_range: Tuple[float, float],
+        fov_range: Tuple[float, float],
+        batch_size: int,
+        device: Any = "cpu",
+        generator: Optional[torch.Generator] = None,
     ) -> None:
         self.device = device
         self.batch_size = batch_size
+        self.size = size
+        self.generator = generator
 
-        with torch.no_grad():
-            self.base_mapping = prepare_base_mapping(size, phi, theta, fov, batch_size, device)
+        self.low = torch.tensor([phi_range[0], theta_range[0], fov_range[0]])
+        self.high = torch.tensor([phi_range[1], theta_range[1], fov_range[1]])
+
+    def sample_poses(self, n: int) -> torch.Tensor:
+        return self.low + (self.high - self.low) * torch.rand((n, 3), generator=self.generator)
 
     @torch.no_grad()
-    def convert(self, pano_batch: torch.Tensor) -> torch.Tensor:
+    def convert(
+        self, pano_batch: torch.Tensor, poses: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         if len(pano_batch.shape) != 4:
             raise TypeError("expected pano shape to be (N, C, H, W)")
 
@@ -77,4 +244,10 @@ class PanoConverter:
         if n_batches > self.batch_size:
             raise TypeError("too many batches")
 
-        return F.grid_sample(pano_batch.to(self.device), self.base_mapping[:n_batches, ...], align_corners=True)
+        if poses is None:
+            poses = self.sample_poses(n_batches)
+        if poses.shape != (n_batches, 3):
+            raise TypeError("expected poses shape to be (N, 3)")
+
+        mapping = prepare_mapping(self.size, *poses.to(self.device, torch.float).unbind(dim=-1))
+        return sample_panoramas(pano_batch, mapping), poses
@@ -0,0 +1,12 @@
+from typing import *
+
+import numpy as np
+
+
+def heading_poses(n: int, theta: float, fov: float, phi: float = 0) -> List[Tuple[float, float, float]]:
+    return [((phi + 2 * np.pi * k / n + np.pi) % (2 * np.pi) - np.pi, theta, fov) for k in range(n)]
+
+
+def cubemap_poses() -> List[Tuple[float, float, float]]:
+    fov = np.pi / 2
+    return heading_poses(4, 0, fov) + [(0, -np.pi / 2, fov), (0, np.pi / 2, fov)]
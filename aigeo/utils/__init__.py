@@ -3,7 +3,12 @@ from .country_codes import (
     country_codes_to_index,
     n_country_codes,
 )
+from .json_stream import JsonWriter, iter_json_items, iter_locations, write_json_items
+from .jsonl import append_json_line, iter_json_lines, open_json_lines_for_append
+from .metrics import Metrics, MetricsExporter, export_metrics, get_metrics, set_metrics
 from .other import batchedby, get_first, safe_index
+from .parallel import BoundedExecutor, prefetch_map
+from .tasks import AsyncBoundedExecutor, LoopLagMonitor, limited, map_unordered
 
 __all__ = [
     country_codes_by_index,
@@ -12,4 +17,22 @@ __all__ = [
     get_first,
     safe_index,
     batchedby,
+    prefetch_map,
+    BoundedExecutor,
+    map_unordered,
+    limited,
+    AsyncBoundedExecutor,
+    LoopLagMonitor,
+    iter_json_lines,
+    open_json_lines_for_append,
+    append_json_line,
+    iter_json_items,
+    iter_locations,
+    JsonWriter,
+    write_json_items,
+    Metrics,
+    MetricsExporter,
+    export_metrics,
+    get_metrics,
+    set_metrics,
 ]
@@ -0,0 +1,207 @@
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import *
+
+import orjson
+
+from .jsonl import iter_json_lines, open_json_lines_for_append
+
+_WHITESPACE = b" \t\r\n"
+_QUOTE = ord('"')
+_BACKSLASH = ord("\\")
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+_SCALAR_END = re.compile(rb"[,\]}\s]")
+
+
+# reads JSON file by chunks, only the value being parsed is kept in memory
+class _JsonScanner:
+    def __init__(self, f: BinaryIO, chunk_size: int) -> None:
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def _read(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        self.buffer += chunk
+        return len(chunk) > 0
+
+    def _read_or_fail(self) -> None:
+        if not self._read():
+            raise ValueError("unexpected end of JSON file")
+
+    def peek(self) -> int:
+        # next non-whitespace byte, parsed values are dropped from buffer here
+        if self.pos >= self.chunk_size:
+            del self.buffer[: self.pos]
+            self.pos = 0
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            del self.buffer[: self.pos]
+            self.pos = 0
+            self._read_or_fail()
+
+    def expect(self, chars: bytes) -> int:
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"invalid JSON file: expected one of {chars.decode()!r}, got {chr(char)!r}")
+        self.pos += 1
+        return char
+
+    def read_value(self) -> Any:
+        self.peek()
+        end = self._value_end()
+        value = orjson.loads(self.buffer[self.pos : end])
+        self.pos = end
+        return value
+
+    def skip_value(self) -> None:
+        self.peek()
+        self.pos = self._value_end()
+
+    def _value_end(self) -> int:
+        first = self.buffer[self.pos]
+        if first in b"[{":
+            depth = 0
+            i = self.pos
+            while True:
+                match = _STRUCTURE.search(self.buffer, i)
+                if match is None:
+                    i = len(self.buffer)
+                    self._read_or_fail()
+                    continue
+                i = match.end()
+                char = self.buffer[match.start()]
+                if char == _QUOTE:
+                    i = self._string_end(i)
+                elif char in b"[{":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return i
+
+        if first == _QUOTE:
+            return self._string_end(self.pos + 1)
+
+        # number, true, false or null
+        i = self.pos
+        while True:
+            match = _SCALAR_END.search(self.buffer, i)
+            if match is not None:
+                return match.start()
+            i = len(self.buffer)
+            if not self._read():
+                return i
+
+    def _string_end(self, i: int) -> int:
+        # position after the closing quote of string, whose content starts at i
+        while True:
+            end = self.buffer.find(b'"', i)
+            if end < 0:
+                i = len(self.buffer)
+                self._read_or_fail()
+                continue
+            n_backslashes = 0
+            while self.buffer[end - 1 - n_backslashes] == _BACKSLASH:
+                n_backslashes += 1
+            if n_backslashes % 2 == 0:
+                return end + 1
+            i = end + 1
+
+
+def iter_json_items(path: str | Path, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    # items of JSON array, or of "customCoordinates" array of JSON object (map export), parsed one by one
+    with open(path, "rb") as f:
+        scanner = _JsonScanner(f, chunk_size)
+        if scanner.expect(b"[{") == ord("{"):
+            while True:
+                if scanner.peek() != _QUOTE:
+                    raise ValueError("unknown format of JSON file")
+                key = scanner.read_value()
+                scanner.expect(b":")
+                if key == "customCoordinates":
+                    scanner.expect(b"[")
+                    break
+                scanner.skip_value()
+                if scanner.expect(b",}") == ord("}"):
+                    raise ValueError("unknown format of JSON file")
+
+        if scanner.peek() == ord("]"):
+            return
+        while True:
+            yield scanner.read_value()
+            if scanner.expect(b",]") == ord("]"):
+                return
+
+
+def iter_locations(path: str | Path) -> Iterator[Any]:
+    # JSON lines (.jsonl), JSON array or map export with customCoordinates
+    if Path(path).suffix == ".jsonl":
+        return iter_json_lines(path)
+    return iter_json_items(path)
+
+
+# writes items one by one, as JSON lines (.jsonl) or JSON array
+class JsonWriter:
+    def __init__(self, path: str | Path, append: bool = False) -> None:
+        self.path = Path(path)
+        self.lines = self.path.suffix == ".jsonl"
+        self.count = 0
+
+        # output is written to a temporary file, which replaces it when complete,
+        # so that the output can be the same file as the input being read
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        if self.lines:
+            if append and self.path.exists():
+                shutil.copyfile(self.path, self.tmp_path)
+                self.count = sum(1 for _ in iter_json_lines(self.tmp_path, skip_invalid=True))
+                self.file = open_json_lines_for_append(self.tmp_path)
+            else:
+                self.file = open(self.tmp_path, "wb")
+        else:
+            self.file = open(self.tmp_path, "wb")
+            self.file.write(b"[")
+            if append and self.path.exists():
+                for item in iter_json_items(self.path):
+                    self.write(item)
+
+    def write(self, item: Any) -> None:
+        if self.lines:
+            self.file.write(orjson.dumps(item) + b"\n")
+        else:
+            if self.count > 0:
+                self.file.write(b",")
+            self.file.write(orjson.dumps(item))
+        self.count += 1
+
+    def close(self) -> None:
+        if not self.lines:
+            self.file.write(b"]")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], *exc_info: Any) -> None:
+        # output of a failed run does not replace the previous one, interrupted run keeps what has been written
+        if exc_type is None or issubclass(exc_type, KeyboardInterrupt):
+            self.close()
+        else:
+            self.discard()
+
+
+def write_json_items(path: str | Path, items: Iterable[Any]) -> None:
+    with JsonWriter(path) as writer:
+        for item in items:
+            writer.write(item)
@@ -0,0 +1,33 @@
+from pathlib import Path
+from typing import *
+
+import orjson
+
+
+def iter_json_lines(path: str | Path, skip_invalid: bool = False) -> Iterator[Any]:
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # lines of append-only files can be cut off by a crash
+                if not skip_invalid:
+                    raise
+
+
+def open_json_lines_for_append(path: str | Path) -> BinaryIO:
+    f = open(path, "ab")
+    # last line could be cut off by a crash, new lines should not be glued to it
+    if f.tell() > 0:
+        with open(path, "rb") as tail:
+            tail.seek(-1, 2)
+            if tail.read(1) != b"\n":
+                f.write(b"\n")
+    return f
+
+
+def append_json_line(f: BinaryIO, obj: Any) -> None:
+    f.write(orjson.dumps(obj) + b"\n")
+    f.flush()
@@ -0,0 +1,233 @@
+import bisect
+import contextlib
+import http.server
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+from .jsonl import append_json_line, open_json_lines_for_append
+
+# upper bounds of histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+type Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        # (upper bound, number of observations not greater than it)
+        total = 0
+        result = []
+        for bound, count in zip([*self.buckets, float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+# counters, gauges and latency histograms keyed by name and labels. Disabled metrics ignore all updates,
+# so that instrumented code does not need to check whether instrumentation is on
+class Metrics:
+    def __init__(self, enabled: bool = True, prefix: str = "aigeo") -> None:
+        self.enabled = enabled
+        self.prefix = prefix
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels: Any) -> None:
+        # gauge, e.g. number of items in a queue
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[name, _labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextlib.contextmanager
+    def track(self, name: str, **labels: Any) -> Iterator[None]:
+        # gauge of calls currently inside the block
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = [{"name": k[0], "labels": dict(k[1]), "value": v} for k, v in self.counters.items()]
+            gauges = [{"name": k[0], "labels": dict(k[1]), "value": v} for k, v in self.gauges.items()]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum,
+                    "buckets": {str(bound): count for bound, count in h.cumulative()},
+                }
+                for (name, labels), h in self.histograms.items()
+            ]
+        return {"time": time.time(), "counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for kind, values in [("counter", self.counters), ("gauge", self.gauges)]:
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+                    for (other, labels), value in values.items():
+                        if other == name:
+                            lines.append(f"{self.prefix}_{name}{_format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (other, labels), h in self.histograms.items():
+                    if other != name:
+                        continue
+                    for bound, count in h.cumulative():
+                        le = "+Inf" if bound == float("inf") else str(bound)
+                        lines.append(f"{self.prefix}_{name}_bucket{_format_labels((*labels, ('le', le)))} {count}")
+                    lines.append(f"{self.prefix}_{name}_sum{_format_labels(labels)} {h.sum}")
+                    lines.append(f"{self.prefix}_{name}_count{_format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# periodically appends snapshots of metrics to a JSON lines file and/or serves them
+# in Prometheus text format on http://127.0.0.1:port/metrics
+class MetricsExporter:
+    def __init__(
+        self, metrics: Metrics, path: Optional[str | Path] = None, port: Optional[int] = None, interval: float = 10
+    ) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self._server: Optional[http.server.ThreadingHTTPServer] = None
+
+        if path is not None:
+            self.file = open_json_lines_for_append(path)
+            self._writer = threading.Thread(target=self._write_periodically, daemon=True)
+            self._writer.start()
+
+        if port is not None:
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    if self.path.split("?")[0] not in ["/", "/metrics"]:
+                        self.send_error(404)
+                        return
+                    body = metrics.to_prometheus().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args: Any) -> None:
+                    pass
+
+            self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _write_periodically(self) -> None:
+        while not self._stop.wait(self.interval):
+            append_json_line(self.file, self.metrics.snapshot())
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            # the last snapshot has totals of the whole run
+            append_json_line(self.file, self.metrics.snapshot())
+            self.file.close()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def export_metrics(
+    path: Optional[str | Path], port: Optional[int], interval: float = 10
+) -> ContextManager[Optional[MetricsExporter]]:
+    # instrumentation is enabled only when metrics are exported somewhere
+    if path is None and port is None:
+        return contextlib.nullcontext()
+    metrics = Metrics()
+    set_metrics(metrics)
+    return MetricsExporter(metrics, path, port, interval)
+
+
+_metrics = Metrics(enabled=False)
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Metrics) -> None:
+    global _metrics
+    _metrics = metrics
@@ -1,4 +1,3 @@
-from collections import defaultdict
 from typing import *
 
 
@@ -20,11 +19,61 @@ def safe_index(obj: Any, indices: List[int], raise_on_error: bool = False) -> Op
     return pobj
 
 
-def batchedby[T](iterable: Iterable[T], key: Callable[[T], Any], n: int) -> Iterator[List[T]]:
-    groups = defaultdict(list)
-    for x in iter(iterable):
+def batchedby[T](
+    iterable: Iterable[T],
+    key: Callable[[T], Any],
+    n: int,
+    max_items: Optional[int] = None,
+    max_size: Optional[float] = None,
+    size: Callable[[T], float] = lambda x: 1,
+    max_age: Optional[int] = None,
+    flush: str = "oldest",
+) -> Iterator[List[T]]:
+    # groups items with equal keys into batches of n. Partially filled groups are flushed early when
+    # they hold more than max_items items or more than max_size in total (the oldest or the largest group first),
+    # or when max_age more items have been read since the group was started
+    if flush not in ["oldest", "largest"]:
+        raise ValueError(f"unknown flush policy: {flush}")
+
+    # dicts keep insertion order, so the first group is always the oldest
+    groups: Dict[Any, List[T]] = {}
+    started: Dict[Any, int] = {}
+    sizes: Dict[Any, float] = {}
+    n_items = 0
+    total_size = 0
+
+    def pop(k: Any) -> List[T]:
+        nonlocal n_items, total_size
+        group = groups.pop(k)
+        n_items -= len(group)
+        total_size -= sizes.pop(k)
+        del started[k]
+        return group
+
+    def over_budget() -> bool:
+        return (max_items is not None and n_items > max_items) or (max_size is not None and total_size > max_size)
+
+    for i, x in enumerate(iterable):
         k = key(x)
+        if k not in groups:
+            groups[k] = []
+            started[k] = i
+            sizes[k] = 0
+        x_size = size(x)
         groups[k].append(x)
+        sizes[k] += x_size
+        n_items += 1
+        total_size += x_size
+
         if len(groups[k]) == n:
-            yield groups.pop(k)
-    yield from groups.values()
+            yield pop(k)
+        while max_age is not None and len(groups) > 0 and i - started[next(iter(groups))] >= max_age:
+            yield pop(next(iter(groups)))
+        while over_budget():
+            if flush == "oldest":
+                yield pop(next(iter(groups)))
+            else:
+                yield pop(max(groups, key=sizes.__getitem__))
+
+    while len(groups) > 0:
+        yield pop(next(iter(groups)))
@@ -0,0 +1,52 @@
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import *
+
+
+def prefetch_map[T, R](fn: Callable[[T], R], iterable: Iterable[T], executor: Executor, depth: int) -> Iterator[R]:
+    # ordered map, which keeps up to `depth` calls running ahead of the consumer
+    it = iter(iterable)
+    futures = deque(executor.submit(fn, x) for x in itertools.islice(it, max(depth, 1)))
+    while futures:
+        future = futures.popleft()
+        futures.extend(executor.submit(fn, x) for x in itertools.islice(it, 1))
+        yield future.result()
+
+
+class BoundedExecutor:
+    def __init__(self, max_workers: int, max_pending: int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+        self.error: Optional[BaseException] = None
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        if self.error is not None:
+            raise self.error
+
+        # blocks when too many tasks are pending, so that their arguments do not pile up in memory
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait)
+        if self.error is not None:
+            raise self.error
+
+    def _on_done(self, future: Future) -> None:
+        self.semaphore.release()
+        if not future.cancelled() and future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.shutdown()
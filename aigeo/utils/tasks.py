@@ -0,0 +1,115 @@
+import asyncio
+import contextlib
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+from .metrics import get_metrics
+
+
+async def map_unordered[T, R](
+    fn: Callable[[T], Awaitable[R]], iterable: Iterable[T], limit: int
+) -> AsyncIterator[Tuple[T, R]]:
+    # runs up to `limit` calls at once and starts a new one as soon as any call finishes
+    it = iter(iterable)
+    pending: Set[asyncio.Task] = set()
+
+    async def run(x: T) -> Tuple[T, R]:
+        return x, await fn(x)
+
+    def fill() -> None:
+        for x in itertools.islice(it, limit - len(pending)):
+            pending.add(asyncio.ensure_future(run(x)))
+
+    fill()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            fill()
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def limited[R](semaphore: Optional[asyncio.Semaphore], coro: Awaitable[R]) -> R:
+    if semaphore is None:
+        return await coro
+    async with semaphore:
+        return await coro
+
+
+class AsyncBoundedExecutor:
+    # runs blocking calls in a thread pool, callers wait (without blocking event loop) while
+    # too many calls are pending, so that their arguments and results do not pile up in memory.
+    # With max_workers=0 calls run right in event loop
+    def __init__(self, max_workers: int, max_pending: int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers) if max_workers > 0 else None
+        self.semaphore = asyncio.Semaphore(max(max_pending, 1))
+
+    async def run[R](self, fn: Callable[..., R], *args: Any) -> R:
+        if self.executor is None:
+            return fn(*args)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.shutdown()
+
+
+class LoopLagMonitor:
+    # measures how late event loop wakes up a task sleeping for `interval` seconds,
+    # percentiles are computed over the last `max_samples` measurements
+    def __init__(self, interval: float = 0.01, max_samples: int = 100_000) -> None:
+        self.interval = interval
+        self.samples: Deque[float] = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.samples.append(lag)
+            self.count += 1
+            self.total += lag
+            self.max = max(self.max, lag)
+            get_metrics().observe("loop_lag_seconds", lag)
+
+    def stats(self) -> Dict[str, float]:
+        # in milliseconds
+        samples = sorted(self.samples)
+
+        def percentile(q: float) -> float:
+            return 1000 * samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.0
+
+        return {
+            "mean": 1000 * self.total / max(self.count, 1),
+            "p50": percentile(0.5),
+            "p99": percentile(0.99),
+            "max": 1000 * self.max,
+        }
+
+    async def __aenter__(self) -> Self:
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
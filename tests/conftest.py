@@ -0,0 +1,22 @@
+import asyncio
+import threading
+from typing import *
+
+import pytest
+
+from aigeo.bench.mock_server import MockStreetViewServer
+
+
+@pytest.fixture
+def mock_server() -> Iterator[MockStreetViewServer]:
+    # server runs in its own event loop, panoload creates another one
+    server = MockStreetViewServer(metadata_latency=0, tile_latency=0, tile_size=(32, 32), n_zooms=4)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    yield server
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
@@ -0,0 +1,73 @@
+import argparse
+from pathlib import Path
+from typing import *
+
+import orjson
+import pytest
+from PIL import Image
+
+from aigeo.bench.mock_server import MockStreetViewServer
+from aigeo.cli.panoload.args import setup_parser
+from aigeo.cli.panoload.main import main
+
+
+def run_panoload(server: MockStreetViewServer, infile: Path, output_dir: Path, *options: str) -> List[Any]:
+    parser = argparse.ArgumentParser()
+    setup_parser(parser)
+    urls = ["--api-url", server.url, "--tiles-url", server.url]
+    main(parser.parse_args([str(infile), "-o", str(output_dir), *urls, *options]))
+    return orjson.loads((output_dir / "storage.json").read_bytes())
+
+
+def write_locations(path: Path, n: int) -> None:
+    path.write_bytes(orjson.dumps([{"panoid": f"pano{i:02}"} for i in range(n)]))
+
+
+def test_rerun_with_higher_zoom(tmp_path: Path, mock_server: MockStreetViewServer) -> None:
+    infile = tmp_path / "locations.json"
+    write_locations(infile, 3)
+    output_dir = tmp_path / "output"
+
+    locations = run_panoload(mock_server, infile, output_dir, "-z", "1")
+    assert all(Image.open(output_dir / location["panorama"]).size == (64, 32) for location in locations)
+
+    tiles = mock_server.counters["tiles"]
+    locations = run_panoload(mock_server, output_dir / "storage.json", output_dir, "-z", "1", "2")
+    assert mock_server.counters["tiles"] > tiles
+    for location in locations:
+        sizes = {zoom: Image.open(output_dir / path).size for zoom, path in location["panoramas"].items()}
+        assert sizes == {"1": (64, 32), "2": (128, 64)}
+        assert location["panorama"] == location["panoramas"]["2"]
+
+    # nothing is downloaded, once all zoom levels are stored
+    tiles = mock_server.counters["tiles"]
+    run_panoload(mock_server, output_dir / "storage.json", output_dir, "-z", "1", "2")
+    assert mock_server.counters["tiles"] == tiles
+
+
+def test_rerun_with_more_workers(tmp_path: Path, mock_server: MockStreetViewServer) -> None:
+    infile = tmp_path / "locations.json"
+    write_locations(infile, 6)
+    output_dir = tmp_path / "output"
+
+    for workers in ["2", "3"]:
+        locations = run_panoload(mock_server, infile, output_dir, "-z", "0", "-w", workers)
+        assert sorted(location["panoid"] for location in locations) == [f"pano{i:02}" for i in range(6)]
+        assert all((output_dir / location["panorama"]).exists() for location in locations)
+        assert not any(".shard-" in path.name for path in output_dir.iterdir())
+
+
+def test_journal_of_other_options(tmp_path: Path, mock_server: MockStreetViewServer) -> None:
+    infile = tmp_path / "locations.json"
+    write_locations(infile, 3)
+    output_dir = tmp_path / "output"
+
+    run_panoload(mock_server, infile, output_dir, "-z", "0", "-j")
+    with pytest.raises(ValueError, match="journal"):
+        run_panoload(mock_server, infile, output_dir, "-z", "0", "1", "-j")
+    locations = run_panoload(mock_server, infile, output_dir, "-z", "0", "1", "-j", "--journal-filename", "z01.jsonl")
+    assert all(set(location["panoramas"]) == {"0", "1"} for location in locations)
+
+    # merged journal of workers is started over
+    locations = run_panoload(mock_server, infile, output_dir, "-z", "1", "-j", "-w", "2")
+    assert all(location["panorama"].endswith("_z1.jpg") for location in locations)
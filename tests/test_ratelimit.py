@@ -0,0 +1,34 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from aigeo.bench.mock_server import MockStreetViewServer
+from aigeo.google import RateLimiter, set_base_urls, single_image_search
+
+
+def test_burst_of_failures_decreases_rate_once() -> None:
+    limiter = RateLimiter(rate=100, adaptive=True)
+    for _ in range(10):
+        limiter.record(503, latency=1)
+    assert limiter.rate == 50
+    # request sent after the decrease
+    limiter.record(None, latency=0)
+    assert limiter.rate == 25
+
+
+def test_in_band_throttling() -> None:
+    async def search(limiter: RateLimiter) -> None:
+        async with MockStreetViewServer(metadata_latency=0, throttle_rate=1) as server:
+            set_base_urls(server.url, server.url)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    await single_image_search(session, 0, 0, n_retries=2, limiter=limiter)
+            finally:
+                set_base_urls()
+
+    limiter = RateLimiter(rate=10, adaptive=True, backoff_base=0)
+    with pytest.raises(RuntimeError, match="currently unavailable"):
+        asyncio.run(search(limiter))
+    assert limiter.counters["throttled"] == 2
+    assert limiter.rate == 2.5
@@ -0,0 +1,50 @@
+import argparse
+from pathlib import Path
+from typing import *
+
+import orjson
+import pytest
+
+from aigeo.bench.mock_server import MockStreetViewServer
+from aigeo.cli.sample.args import setup_parser
+from aigeo.cli.sample.main import main
+
+from .test_panoload import run_panoload, write_locations
+
+
+def run_sample(storage: Path, output_dir: Path, *options: str) -> List[Any]:
+    parser = argparse.ArgumentParser()
+    setup_parser(parser)
+    main(parser.parse_args([str(storage), "-o", str(output_dir), "-s", "16", *options]))
+    return orjson.loads((output_dir / "sample.json").read_bytes())
+
+
+@pytest.fixture
+def storage(tmp_path: Path, mock_server: MockStreetViewServer) -> Path:
+    write_locations(tmp_path / "locations.json", 4)
+    run_panoload(mock_server, tmp_path / "locations.json", tmp_path / "output", "-z", "0")
+    return tmp_path / "output" / "storage.json"
+
+
+def test_skip_unloaded_locations(tmp_path: Path, storage: Path) -> None:
+    locations = orjson.loads(storage.read_bytes())
+    # interrupted panoload, and panorama removed afterwards
+    del locations[0]["panorama"]
+    (storage.parent / locations[1]["panorama"]).unlink()
+    storage.write_bytes(orjson.dumps(locations))
+
+    images = run_sample(storage, tmp_path / "sample", "--headings", "2")
+    assert len(images) == 4
+    assert all((tmp_path / "sample" / image["image"]).exists() for image in images)
+
+
+def test_failed_run_keeps_output(tmp_path: Path, storage: Path) -> None:
+    images = run_sample(storage, tmp_path / "sample")
+    assert len(images) == 4
+
+    locations = orjson.loads(storage.read_bytes())
+    (storage.parent / locations[2]["panorama"]).write_bytes(b"not a panorama")
+    with pytest.raises(Exception):
+        run_sample(storage, tmp_path / "sample")
+    assert orjson.loads((tmp_path / "sample" / "sample.json").read_bytes()) == images
+    assert not (tmp_path / "sample" / "sample.json.tmp").exists()